@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Compares the SpotifyUtil base62 codec with the digit by digit version it
+# replaced, on 100k random track ids.
+
+import os
+import sys
+import time
+import binascii
+sys.path.append("..")
+from spotify_web.spotify import SpotifyUtil, base62
+
+COUNT = 100000
+
+
+def old_id2uri(uritype, v):
+    res = []
+    v = int(v, 16)
+    while v > 0:
+        res = [v % 62] + res
+        v /= 62
+    id = ''.join([base62[i] for i in res])
+    return "spotify:" + uritype + ":" + id.rjust(22, "0")
+
+
+def old_uri2id(uri):
+    parts = uri.split(":")
+    if len(parts) > 3 and parts[3] == "playlist":
+        s = parts[4]
+    else:
+        s = parts[2]
+
+    v = 0
+    for c in s:
+        v = v * 62 + base62.index(c)
+    return hex(v)[2:-1].rjust(32, "0")
+
+
+def old_gid2uri(uritype, gid):
+    return old_id2uri(uritype, SpotifyUtil.gid2id(gid))
+
+
+def bench(name, fn, baseline=None):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+
+    speedup = " ({:.1f}x)".format(baseline / elapsed) if baseline else ""
+    print "{:<40} {:8.3f}s {:8.2f}us/id{}".format(name, elapsed, elapsed / COUNT * 1e6, speedup)
+    return elapsed
+
+
+if __name__ == '__main__':
+    gids = [os.urandom(16) for i in range(COUNT)]
+    ids = [binascii.hexlify(gid) for gid in gids]
+    uris = SpotifyUtil.gids2uris("track", gids)
+
+    print "{} ids".format(COUNT)
+
+    base = bench("gid2uri (old)", lambda: [old_gid2uri("track", gid) for gid in gids])
+    bench("gid2uri", lambda: [SpotifyUtil.gid2uri("track", gid) for gid in gids], base)
+    bench("gids2uris", lambda: SpotifyUtil.gids2uris("track", gids), base)
+
+    base = bench("id2uri (old)", lambda: [old_id2uri("track", id) for id in ids])
+    bench("id2uri", lambda: [SpotifyUtil.id2uri("track", id) for id in ids], base)
+
+    base = bench("uri2id (old)", lambda: [old_uri2id(uri) for uri in uris])
+    bench("uri2id", lambda: [SpotifyUtil.uri2id(uri) for uri in uris], base)
+
+    base = bench("uri2id + unhexlify (old)", lambda: [binascii.unhexlify(old_uri2id(uri)) for uri in uris])
+    bench("uris2gids", lambda: SpotifyUtil.uris2gids(uris), base)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Compares the codec used for sp/hm_b64 frames with the base64 module
+# calls it replaced, on a 100 track multi-get request and reply.
+
+import os
+import sys
+import time
+import base64
+sys.path.append("..")
+from spotify_web.codec import encode_message, decode_mget_replies
+from spotify_web.proto import mercury_pb2, metadata_pb2
+
+COUNT = 2000
+ITEMS = 100
+
+
+def old_encode(requests):
+    return base64.encodestring(requests.SerializeToString())
+
+
+def old_decode(text):
+    mget_reply = mercury_pb2.MercuryMultiGetReply()
+    mget_reply.ParseFromString(base64.decodestring(text))
+    return mget_reply.reply
+
+
+def parse_bodies(replies):
+    for reply in replies:
+        track = metadata_pb2.Track()
+        track.ParseFromString(reply.body)
+
+
+def make_track():
+    track = metadata_pb2.Track()
+    track.gid = os.urandom(16)
+    track.name = "Track"
+    track.duration = 200000
+    track.album.gid = os.urandom(16)
+    track.album.name = "Album"
+    track.artist.add(gid=os.urandom(16), name="Artist")
+
+    for i in range(5):
+        track.restriction.add(countries_allowed="SEDEFRGBUSNOFIDK" * 10)
+        track.file.add(file_id=os.urandom(20), format=1)
+
+    return track
+
+
+def bench(name, fn, baseline=None):
+    start = time.time()
+    for i in range(COUNT):
+        fn()
+    elapsed = time.time() - start
+
+    speedup = " ({:.1f}x)".format(baseline / elapsed) if baseline else ""
+    print "{:<40} {:8.3f}s {:8.1f}us/frame{}".format(name, elapsed, elapsed / COUNT * 1e6, speedup)
+    return elapsed
+
+
+if __name__ == '__main__':
+    requests = mercury_pb2.MercuryMultiGetRequest()
+    mget_reply = mercury_pb2.MercuryMultiGetReply()
+
+    for i in range(ITEMS):
+        requests.request.add(body="GET", uri="hm://metadata/track/" + os.urandom(16).encode("hex"))
+        mget_reply.reply.add(status_code=200, content_type="vnd.spotify/metadata-track", ttl=3600,
+                             etag=os.urandom(8), body=make_track().SerializeToString())
+
+    # Frames arrive as unicode from the JSON decoder
+    text = unicode(base64.encodestring(mget_reply.SerializeToString()))
+
+    print "{} frames of {} items, request {} bytes ({} before), reply {} bytes".format(
+        COUNT, ITEMS, len(encode_message(requests)), len(old_encode(requests)), len(text))
+
+    base = bench("encode request (old)", lambda: old_encode(requests))
+    bench("encode request", lambda: encode_message(requests), base)
+
+    base = bench("decode reply (old)", lambda: old_decode(text))
+    bench("decode reply", lambda: decode_mget_replies(text), base)
+
+    base = bench("decode reply + bodies (old)", lambda: parse_bodies(old_decode(text)))
+    bench("decode reply + bodies", lambda: parse_bodies(decode_mget_replies(text)), base)
@@ -1,32 +1,192 @@
 #!/usr/bin/env python
 
 import sys
+import time
+from threading import Thread, Event, RLock
+from urlparse import urlparse, parse_qs
 sys.path.append("../..")
 from spotify_web.friendly import Spotify
 import cherrypy
 
+# Number of upcoming queue entries resolved ahead of playback
+PREFETCH = 3
+# Lifetime of file URLs that do not tell when they expire
+DEFAULT_TTL = 300
+# File URLs this close to their expiry are resolved again
+EXPIRY_MARGIN = 30
+
+
+def url_expiry(url):
+    query = parse_qs(urlparse(url).query)
+
+    try:
+        if "__gda__" in query:
+            return int(query["__gda__"][0].split("_")[0])
+
+        for key in ("Expires", "expires", "e"):
+            if key in query:
+                return int(query[key][0])
+    except ValueError:
+        pass
+
+    return time.time() + DEFAULT_TTL
+
+
+class TrackResolver(object):
+    """Resolves track URIs to file URLs with one long-lived session.
+
+    File URLs are cached until shortly before they expire. The play queue
+    is announced through queue(), whenever a track is resolved the next
+    PREFETCH entries are resolved in the background.
+    """
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.spotify = None
+
+        self.lock = RLock()
+        self.urls = {}
+        self.pending = {}
+        self.queue = []
+
+    def session(self):
+        with self.lock:
+            if self.spotify is None or not self.spotify.logged_in():
+                if self.spotify is not None:
+                    self.spotify.logout()
+
+                self.spotify = Spotify(self.username, self.password)
+
+            return self.spotify
+
+    def logout(self):
+        with self.lock:
+            if self.spotify is not None:
+                self.spotify.logout()
+                self.spotify = None
+
+    def cached(self, uri):
+        with self.lock:
+            entry = self.urls.get(uri)
+
+        if entry is not None and entry[1] - EXPIRY_MARGIN > time.time():
+            return entry[0]
+        else:
+            return None
+
+    def set_queue(self, uris, start=0):
+        with self.lock:
+            self.queue = uris
+
+        self.prefetch(uris[start:start + PREFETCH])
+
+    def resolve(self, uri, timeout=30):
+        with self.lock:
+            if uri in self.queue:
+                index = self.queue.index(uri)
+                self.prefetch(self.queue[index + 1:index + 1 + PREFETCH])
+
+        url = self.cached(uri)
+        if url is None:
+            self.fetch([uri])
+
+            with self.lock:
+                event = self.pending.get(uri)
+
+            if event is not None:
+                event.wait(timeout)
+
+            url = self.cached(uri)
+
+        return url
+
+    def prefetch(self, uris):
+        if uris:
+            thread = Thread(target=self.fetch, args=(uris,))
+            thread.daemon = True
+            thread.start()
+
+    def fetch(self, uris):
+        with self.lock:
+            uris = [uri for uri in uris if uri not in self.pending and self.cached(uri) is None]
+
+            for uri in uris:
+                self.pending[uri] = Event()
+
+        if not uris:
+            return
+
+        # URIs handed to a track_uri request, that request settles them.
+        # Everything else is settled here, even if logging in or the
+        # metadata request fails, so nobody waits on them forever.
+        requested = set()
+
+        try:
+            api = self.session().api
+
+            # One metadata request for the whole batch, the file URLs are
+            # requested concurrently.
+            try:
+                tracks = api.metadata_request(uris)
+            except Exception:
+                tracks = False
+
+            if type(tracks) != list:
+                tracks = [tracks] if len(uris) == 1 else [False] * len(uris)
+
+            for uri, track in zip(uris, tracks):
+                if track:
+                    promise = api.track_uri(track, lambda resp, uri=uri: self.store(uri, resp))
+
+                    if promise is not None:
+                        promise.done(None, lambda error, uri=uri: self.store(uri, False))
+                        requested.add(uri)
+        finally:
+            for uri in uris:
+                if uri not in requested:
+                    self.store(uri, False)
+
+    def store(self, uri, resp):
+        with self.lock:
+            if resp and "uri" in resp:
+                self.urls[uri] = (resp["uri"], url_expiry(resp["uri"]))
+
+            event = self.pending.pop(uri, None)
+
+        if event is not None:
+            event.set()
+
 
 class SpotifyURIHandler(object):
+    def __init__(self, resolver):
+        self.resolver = resolver
+
     def default(self, uri=None):
         if uri is None:
             raise cherrypy.HTTPError(400, "A paramater was expected but not supplied.")
 
-        spotify = Spotify(sys.argv[1], sys.argv[2])
-        track = spotify.objectFromURI(uri)
-        if track is None:
-            spotify.logout()
-            raise cherrypy.HTTPError(404, "Could not find a track with that URI.")
-
-        url = track.getFileURL()
+        url = self.resolver.resolve(uri)
         if not url:
-            spotify.logout()
             raise cherrypy.HTTPError(404, "Could not find a track URL for that URI.")
 
-        spotify.logout()
         raise cherrypy.HTTPRedirect(url)
 
     default.exposed = True
 
+    def queue(self, uris=None, start=0):
+        if uris is None:
+            raise cherrypy.HTTPError(400, "A paramater was expected but not supplied.")
+
+        self.resolver.set_queue(uris.split(","), int(start))
+        return "OK"
+
+    queue.exposed = True
+
+resolver = TrackResolver(sys.argv[1], sys.argv[2])
+resolver.session()
+
+cherrypy.engine.subscribe("exit", resolver.logout)
 cherrypy.engine.autoreload.unsubscribe()
 cherrypy.config.update({"environment": "production"})
-cherrypy.quickstart(SpotifyURIHandler())
+cherrypy.quickstart(SpotifyURIHandler(resolver))
@@ -9,6 +9,8 @@ from threading import Thread, Lock, Event
 from mpd import MPDClient
 import os
 import subprocess
+import urllib
+import urllib2
 
 playing_playlist = None
 current_playlist = None
@@ -165,10 +167,18 @@ def command_play(*args):
 
     global playing_playlist
     playing_playlist = current_playlist
+    uris = [track.getURI() for track in current_playlist.getTracks()]
+    try:
+        # Lets the helper resolve upcoming tracks ahead of time
+        urllib2.urlopen("http://localhost:8080/queue",
+                        urllib.urlencode({"uris": ",".join(uris), "start": play_index}))
+    except IOError:
+        pass
+
     with client:
         client.clear()
-        for track in current_playlist.getTracks():
-            client.add("http://localhost:8080/?uri="+track.getURI())
+        for uri in uris:
+            client.add("http://localhost:8080/?uri="+uri)
         client.play(play_index)
 
     display_playlist()
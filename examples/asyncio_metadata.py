@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append("..")
+import trollius as asyncio
+from trollius import From
+from spotify_web.aio import AsyncSpotifyAPI
+from spotify_web.spotify import SpotifyUtil
+
+
+@asyncio.coroutine
+def print_album(sp, uri):
+    album = yield From(sp.metadata_request(uri))
+    print album.name + " - " + album.artist[0].name + "\n"
+
+    uris = [SpotifyUtil.gid2uri("track", track.gid) for track in album.disc[0].track]
+    tracks = yield From(asyncio.gather(*[sp.metadata_request(uri) for uri in uris]))
+    for track in tracks:
+        print track.name
+
+
+@asyncio.coroutine
+def main(sp, username, password, uri):
+    logged_in = yield From(sp.connect_async(username, password))
+    if not logged_in:
+        print "There was an error logging in"
+        return
+
+    yield From(print_album(sp, uri))
+    sp.shutdown()
+
+if len(sys.argv) < 3:
+    print "Usage: " + sys.argv[0] + " <username> <password> [album URI]"
+else:
+    uri = sys.argv[3] if len(sys.argv) > 3 else "spotify:album:3OmHoatMS34vM7ZKb4WCY3"
+
+    loop = asyncio.get_event_loop()
+    sp = AsyncSpotifyAPI(loop=loop)
+    loop.run_until_complete(main(sp, sys.argv[1], sys.argv[2], uri))
@@ -2,28 +2,11 @@
 
 import sys
 sys.path.append("..")
-from spotify_web.friendly import Spotify
+from spotify_web.sessions import SessionManager
 import cherrypy
 
 
-sessions = {}
-
-
-def get_or_create_session(username, password):
-    if username not in sessions:
-        spotify = Spotify(username, password)
-
-        if not spotify:
-            return False
-        else:
-            sessions[username] = spotify
-
-    return sessions[username]
-
-
-def disconnect_sessions():
-    for username, session in sessions.items():
-        session.logout()
+sessions = SessionManager(max_sessions=1000, idle_timeout=900)
 
 
 class SpotifyURIHandler(object):
@@ -31,7 +14,7 @@ class SpotifyURIHandler(object):
         if uri is None or username is None or password is None:
             raise cherrypy.HTTPError(400, "A paramater was expected but not supplied.")
 
-        spotify = get_or_create_session(username, password)
+        spotify = sessions.get(username, password)
         if not spotify:
             raise cherrypy.HTTPError(403, "Username or password given were incorrect.")
 
@@ -53,7 +36,7 @@ class SpotifyURIHandler(object):
 
     default.exposed = True
 
-cherrypy.engine.subscribe("exit", disconnect_sessions)
+cherrypy.engine.subscribe("exit", sessions.shutdown)
 cherrypy.engine.autoreload.unsubscribe()
 cherrypy.config.update({"environment": "production"})
 cherrypy.quickstart(SpotifyURIHandler())
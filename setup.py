@@ -12,6 +12,9 @@ setup(
         'requests>=1.1.0',
         'ws4py>=0.2.4',
         'lxml>=3.1beta1',
-        'protobuf>=2.4.1',
+        'protobuf>=3.2.0',
         'mechanize'],
+    extras_require={
+        'asyncio': ['trollius'],
+    },
 )
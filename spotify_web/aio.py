@@ -0,0 +1,91 @@
+import logging
+
+import trollius as asyncio
+from trollius import From, Return
+
+from .flow import NORMAL
+from .spotify import SpotifyAPI, SpotifyTimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSpotifyAPI(SpotifyAPI):
+    """SpotifyAPI whose requests are coroutines running on a single event loop."""
+
+    def __init__(self, login_callback_func=None, settings=None, fb_access_token=None, loop=None, **kwargs):
+        SpotifyAPI.__init__(self, login_callback_func, settings, fb_access_token, **kwargs)
+        self.loop = loop or asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def connect_async(self, username, password, timeout=10):
+        # The login handshake itself is driven by the websocket thread, we only
+        # have to keep the blocking wait for it off the loop.
+        logged_in = yield From(self.loop.run_in_executor(None, self.connect, username, password, timeout))
+        raise Return(logged_in)
+
+    def future_from_promise(self, promise):
+        future = asyncio.Future(loop=self.loop)
+
+        def set_result(value):
+            if not future.done():
+                future.set_result(value)
+
+        def set_exception(reason):
+            if not future.done():
+                future.set_exception(reason)
+
+        def fulfilled(value):
+            self.loop.call_soon_threadsafe(set_result, value)
+
+        def rejected(reason):
+            self.loop.call_soon_threadsafe(set_exception, reason)
+
+        promise.done(fulfilled, rejected)
+
+        return future
+
+    def send_command(self, name, args=None, callback=None, **kwargs):
+        # Never block the loop on the in-flight window, queued commands are
+        # sent from the websocket thread as responses free up slots.
+        kwargs["block"] = False
+        promise = self.command_promise(name, args, callback, **kwargs)
+        return self.future_from_promise(promise)
+
+    def settle(self, promise, callback=None):
+        if callback:
+            return SpotifyAPI.settle(self, promise, callback)
+        else:
+            return self.future_from_promise(promise)
+
+    def wrap_request(self, command, args, callback=None, transform=None, retries=3, timeout=10, priority=NORMAL):
+        if callback:
+            # Callback mode stays promise based, the login handshake on the
+            # websocket thread relies on it.
+            return SpotifyAPI.wrap_request(self, command, args, callback, transform, retries, timeout, priority)
+        else:
+            assert retries >= 1
+            assert not transform or hasattr(transform, '__call__')
+
+            return self.request(command, args, transform, retries, timeout, priority)
+
+    @asyncio.coroutine
+    def request(self, command, args, transform=None, retries=3, timeout=10, priority=NORMAL):
+        self.retry_policy.request_started()
+
+        for attempt in range(0, retries):
+            promise = self.request_promise(command, args, transform, timeout, priority=priority)
+            future = self.future_from_promise(promise)
+
+            try:
+                result = yield From(asyncio.wait_for(future, timeout, loop=self.loop))
+            except asyncio.TimeoutError:
+                error = SpotifyTimeoutError()
+            except Exception as e:
+                error = e
+            else:
+                raise Return(result)
+
+            if not self.retry_policy.should_retry(error, attempt, retries):
+                raise error
+
+            yield From(asyncio.sleep(self.retry_policy.delay(error, attempt), loop=self.loop))
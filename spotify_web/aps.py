@@ -0,0 +1,125 @@
+import ssl
+import time
+import socket
+import logging
+from threading import Thread, RLock
+from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class AccessPointSelector(object):
+    """Resolves the access points of a client version and ranks them by speed."""
+
+    RESOLVER_TTL = 600
+    PROBE_TIMEOUT = 2.0
+
+    resolver_cache = {}
+    resolver_lock = RLock()
+
+    def __init__(self, probe=True, login_cache=None):
+        self.probe = probe
+        self.login_cache = login_cache
+        self.handshake = {}
+        self.echo_rtt = {}
+
+    def access_points(self, session, settings, headers=None):
+        hostname = settings["aps"]["resolver"]["hostname"]
+        return self.resolve(session, hostname, str(settings["version"]), headers)
+
+    def resolve(self, session, hostname, version, headers=None):
+        key = (hostname, version)
+
+        with self.resolver_lock:
+            cached = self.resolver_cache.get(key)
+
+        if cached is not None and cached[0] > time.time():
+            logger.debug("Using cached access points for client version {}".format(version))
+
+            # Probed by whichever selector resolved them
+            for ap, seconds in cached[2].items():
+                self.handshake.setdefault(ap, seconds)
+
+            return self.rank(cached[1])
+
+        hostnames = self.login_cache.load_access_points(hostname, version) if self.login_cache else None
+
+        if hostnames is None:
+            resolver_payload = {
+                "client": "24:0:0:" + version
+            }
+
+            resp = session.get('http://' + hostname, params=resolver_payload, headers=headers)
+            hostnames = [ap.split(":")[0] for ap in resp.json()["ap_list"]]
+
+            if self.login_cache:
+                self.login_cache.save_access_points(hostname, version, hostnames)
+        else:
+            logger.debug("Using stored access points for client version {}".format(version))
+
+        if self.probe:
+            self.probe_all(hostnames)
+
+        handshake = dict((ap, self.handshake[ap]) for ap in hostnames if ap in self.handshake)
+
+        with self.resolver_lock:
+            self.resolver_cache[key] = (time.time() + self.RESOLVER_TTL, hostnames, handshake)
+
+        return self.rank(hostnames)
+
+    def probe_all(self, hostnames):
+        threads = []
+
+        for hostname in hostnames:
+            thread = Thread(target=self.probe_one, args=(hostname,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        deadline = time.time() + self.PROBE_TIMEOUT * 2
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+
+    def probe_one(self, hostname, port=443):
+        start = time.time()
+
+        try:
+            sock = socket.create_connection((hostname, port), self.PROBE_TIMEOUT)
+            try:
+                sock.settimeout(self.PROBE_TIMEOUT)
+                ssl.wrap_socket(sock).close()
+            finally:
+                sock.close()
+        except (socket.error, ssl.SSLError) as e:
+            logger.debug("Access point {} is unreachable: {}".format(hostname, e))
+            self.handshake[hostname] = None
+            return
+
+        self.handshake[hostname] = time.time() - start
+        logger.debug("Access point {} answered in {:.3f}s".format(hostname, self.handshake[hostname]))
+
+    def score(self, hostname):
+        if hostname in self.echo_rtt:
+            return self.echo_rtt[hostname]
+
+        handshake = self.handshake.get(hostname)
+        return handshake if handshake is not None else float("inf")
+
+    def rank(self, hostnames):
+        # sorted() is stable, access points we know nothing about keep the
+        # resolver's order.
+        return sorted(hostnames, key=self.score)
+
+    def observe(self, url, rtt):
+        hostname = urlparse(url).hostname
+        previous = self.echo_rtt.get(hostname)
+
+        if previous is None or previous == float("inf"):
+            self.echo_rtt[hostname] = rtt
+        else:
+            self.echo_rtt[hostname] = 0.8 * previous + 0.2 * rtt
+
+    def demote(self, url):
+        # Connecting failed, try everything else first next time
+        hostname = urlparse(url).hostname
+        self.echo_rtt[hostname] = float("inf")
@@ -0,0 +1,214 @@
+import time
+from collections import OrderedDict
+from threading import RLock
+
+from .lazy import LazyMessage
+from .proto import metadata_pb2
+
+# MercuryReply.CachePolicy
+CACHE_NO = 1
+CACHE_PRIVATE = 2
+CACHE_PUBLIC = 3
+
+
+class NegativeCache(object):
+    """Remembers ids the backend reported as missing."""
+
+    def __init__(self, ttl=3600, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = {}
+        self.lock = RLock()
+
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+            elif entry[0] <= time.time():
+                del self.entries[key]
+                return None
+
+            self.hits += 1
+            return entry[1]
+
+    def add(self, key, status_code):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, status_code)
+
+            if len(self.entries) > self.max_size:
+                self.purge()
+
+    def purge(self):
+        with self.lock:
+            now = time.time()
+            self.entries = dict((key, entry) for key, entry in self.entries.items() if entry[0] > now)
+
+            if len(self.entries) > self.max_size:
+                entries = sorted(self.entries.items(), key=lambda item: item[1][0])
+                self.entries = dict(entries[len(entries) - self.max_size:])
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+class MetadataCache(object):
+    """Keeps parsed metadata objects for as long as the backend allows."""
+
+    DEFAULT_TTL = 3600
+
+    PROTOS = {
+        "track": metadata_pb2.Track,
+        "album": metadata_pb2.Album,
+        "artist": metadata_pb2.Artist,
+    }
+
+    def __init__(self, max_size=10000, default_ttl=DEFAULT_TTL, backing_store=None):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.backing_store = backing_store
+        # key -> (obj, expires, etag)
+        self.entries = OrderedDict()
+        self.lock = RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.loaded = 0
+        self.revalidated = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def expiry(self, reply):
+        if reply is not None and reply.HasField("ttl"):
+            return time.time() + reply.ttl
+        else:
+            return time.time() + self.default_ttl
+
+    def remember(self, key, entry):
+        # Callers have to hold the lock
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def lookup(self, key):
+        # Returns (obj, etag, fresh) or None
+        return self.lookup_many([key]).get(key)
+
+    def lookup_many(self, keys):
+        # Returns {key: (obj, etag, fresh)} for the keys that are cached
+        now = time.time()
+        found = {}
+        missing = []
+
+        with self.lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+
+                if entry is None:
+                    missing.append(key)
+                else:
+                    self.entries[key] = entry
+                    found[key] = entry
+
+        if missing and self.backing_store is not None:
+            stored = self.backing_store.get_many(missing)
+
+            with self.lock:
+                for key, (body, expires, etag) in stored.items():
+                    obj = LazyMessage(self.PROTOS[key.type], body)
+                    found[key] = (obj, expires, etag)
+                    self.remember(key, found[key])
+
+                self.loaded += len(stored)
+
+        with self.lock:
+            result = {}
+            hits = 0
+
+            for key, (obj, expires, etag) in found.items():
+                fresh = expires > now
+                result[key] = (obj, etag, fresh)
+                hits += fresh
+
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        return result
+
+    def store_many(self, entries):
+        # entries are (key, obj, reply), reply may be None
+        persist = []
+        forget = []
+
+        with self.lock:
+            for key, obj, reply in entries:
+                if reply is not None and reply.HasField("cache_policy") and reply.cache_policy == CACHE_NO:
+                    self.entries.pop(key, None)
+                    forget.append(key)
+                    continue
+
+                etag = reply.etag if reply is not None and reply.HasField("etag") else None
+                expires = self.expiry(reply)
+
+                if self.max_size > 0:
+                    self.remember(key, (obj, expires, etag))
+
+                if self.backing_store is not None:
+                    body = reply.body if reply is not None and reply.HasField("body") else obj.SerializeToString()
+                    persist.append((key, body, expires, etag))
+
+        if persist:
+            self.backing_store.put_many(persist)
+        if forget and self.backing_store is not None:
+            self.backing_store.delete_many(forget)
+
+    def store(self, key, obj, reply=None):
+        self.store_many([(key, obj, reply)])
+
+    def refresh(self, key, obj, etag=None, reply=None):
+        self.refresh_many([(key, obj, etag, reply)])
+
+    def refresh_many(self, entries):
+        # entries are (key, obj, etag, reply) of objects the backend
+        # confirmed with a 304, obj and etag as returned by the lookup
+        touched = []
+
+        with self.lock:
+            for key, obj, etag, reply in entries:
+                if reply is not None and reply.HasField("etag"):
+                    etag = reply.etag
+
+                expires = self.expiry(reply)
+                touched.append((key, expires, etag))
+
+                if self.max_size > 0:
+                    self.remember(key, (obj, expires, etag))
+
+            self.revalidated += len(touched)
+
+        if touched and self.backing_store is not None:
+            self.backing_store.touch_many(touched)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "loaded": self.loaded,
+                "revalidated": self.revalidated,
+            }
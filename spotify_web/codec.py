@@ -0,0 +1,31 @@
+import binascii
+
+from .proto import mercury_pb2
+
+
+def encode_b64(data):
+    # Standard base64 in one piece, base64.encodestring() breaks lines
+    # every 76 characters in a Python loop
+    return binascii.b2a_base64(data)[:-1]
+
+
+def decode_b64(text):
+    # Accepts str, unicode and buffers, line breaks are ignored
+    return binascii.a2b_base64(text)
+
+
+def encode_message(message):
+    return encode_b64(message.SerializeToString())
+
+
+def decode_message(message_class, text):
+    message = message_class()
+    message.ParseFromString(decode_b64(text))
+
+    return message
+
+
+def decode_mget_replies(text):
+    # The MercuryReply of every item of a multi-get reply, in request order.
+    # The item bodies stay inside the parsed message until they are read.
+    return decode_message(mercury_pb2.MercuryMultiGetReply, text).reply
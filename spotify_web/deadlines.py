@@ -0,0 +1,94 @@
+import time
+import heapq
+import logging
+import itertools
+from threading import Thread, Condition
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineScheduler(object):
+    """Runs callbacks once their deadline has passed."""
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = Condition()
+        self.thread = None
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, timeout, callback, *args):
+        # Returns the entry, for cancel()
+        deadline = time.time() + timeout
+
+        with self.cond:
+            entry = [deadline, next(self.counter), callback, args]
+            heapq.heappush(self.heap, entry)
+
+            if self.thread is None:
+                self.thread = Thread(target=self.run, args=(self.counter,))
+                self.thread.daemon = True
+                self.thread.start()
+            elif self.heap[0] is entry:
+                # The new deadline is earlier than the one the thread sleeps on
+                self.cond.notify()
+
+        return entry
+
+    def cancel(self, entry):
+        with self.cond:
+            if entry[2] is None:
+                return
+
+            entry[2] = None
+            entry[3] = ()
+            self.cancelled += 1
+
+            if self.cancelled * 2 > len(self.heap):
+                self.heap = [pending for pending in self.heap if pending[2] is not None]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def run(self, counter):
+        while True:
+            with self.cond:
+                while True:
+                    if self.counter is not counter:
+                        # stop() was called, a new thread takes over if needed
+                        return
+                    elif not self.heap:
+                        self.cond.wait()
+                    else:
+                        delay = self.heap[0][0] - time.time()
+                        if delay <= 0:
+                            break
+                        self.cond.wait(delay)
+
+                due = []
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    entry = heapq.heappop(self.heap)
+
+                    if entry[2] is None:
+                        self.cancelled -= 1
+                    else:
+                        due.append((entry[2], entry[3]))
+                        # Fired entries can no longer be cancelled
+                        entry[2] = None
+
+            for callback, args in due:
+                try:
+                    callback(*args)
+                except Exception:
+                    logger.exception("Deadline callback failed")
+
+    def stop(self):
+        with self.cond:
+            self.heap = []
+            self.cancelled = 0
+            self.counter = itertools.count()
+            self.thread = None
+            self.cond.notify_all()
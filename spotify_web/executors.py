@@ -0,0 +1,101 @@
+import logging
+from Queue import Queue
+from threading import Thread, RLock
+
+from aplus import Promise
+
+logger = logging.getLogger(__name__)
+
+# SpotifyAPI hands every settled command promise to a callback executor, so
+# callbacks and parse_* transforms never run on the websocket reader thread.
+# Anything with a submit(fn, *args) method works, including the executors of
+# concurrent.futures.
+
+
+class InlineExecutor(object):
+    """Runs callbacks right away on the calling thread."""
+
+    def submit(self, fn, *args):
+        fn(*args)
+
+    def shutdown(self):
+        pass
+
+
+class CallbackThreadPool(object):
+    """Runs callbacks on a fixed set of daemon threads, started on first use."""
+
+    def __init__(self, workers=4):
+        assert workers >= 1
+
+        self.workers = workers
+        self.queue = Queue()
+        self.threads = []
+        self.lock = RLock()
+
+    @property
+    def pending(self):
+        return self.queue.qsize()
+
+    def submit(self, fn, *args):
+        if not self.threads:
+            self.start()
+
+        self.queue.put((fn, args))
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        while True:
+            fn, args = self.queue.get()
+
+            if fn is None:
+                return
+
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("Callback failed")
+
+    def shutdown(self):
+        with self.lock:
+            for thread in self.threads:
+                self.queue.put((None, ()))
+
+            self.threads = []
+
+
+class LoopExecutor(object):
+    """Runs callbacks on an asyncio (or trollius) event loop."""
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def submit(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def shutdown(self):
+        pass
+
+
+def run_in_thread(fn, *args):
+    """Runs fn on a new daemon thread, returns a promise for its result."""
+    promise = Promise()
+
+    def run():
+        try:
+            promise.fulfill(fn(*args))
+        except Exception as e:
+            promise.reject(e)
+
+    thread = Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    return promise
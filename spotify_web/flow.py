@@ -0,0 +1,253 @@
+import time
+import logging
+from collections import deque
+from threading import Condition, Event, RLock
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+PRIORITY_NAMES = {
+    INTERACTIVE: "interactive",
+    NORMAL: "normal",
+    BULK: "bulk",
+}
+
+
+class InFlightWindow(object):
+    """Limits the number of commands awaiting a response."""
+
+    AGING = {
+        INTERACTIVE: 0.0,
+        NORMAL: 0.5,
+        BULK: 5.0,
+    }
+
+    def __init__(self, size, min_size=1, backoff=0.5, cooldown=1.0):
+        assert 1 <= min_size <= size
+        assert 0 < backoff < 1
+
+        self.max_size = size
+        self.min_size = min_size
+        self.backoff = backoff
+        # Rate limit errors arrive in bursts for a whole window of requests,
+        # only the first one in a cooldown period shrinks the window.
+        self.cooldown = cooldown
+
+        self.limit = float(size)
+        self.in_flight = 0
+        self.queues = dict((priority, deque()) for priority in PRIORITY_NAMES)
+        self.last_decrease = 0
+
+        self.rate_limited = 0
+        self.queued_total = 0
+        self.wait_count = dict((priority, 0) for priority in PRIORITY_NAMES)
+        self.wait_total = dict((priority, 0.0) for priority in PRIORITY_NAMES)
+        self.wait_max = dict((priority, 0.0) for priority in PRIORITY_NAMES)
+
+        self.cond = Condition(RLock())
+
+    @property
+    def size(self):
+        return int(self.limit)
+
+    @property
+    def queue_depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def has_room(self):
+        return self.in_flight < self.size
+
+    def admit(self):
+        # Account for a command that is sent regardless of the window
+        with self.cond:
+            self.in_flight += 1
+
+    def take_slot(self, priority):
+        # Callers have to hold the lock
+        if self.has_room() and not self.queue_depth:
+            self.in_flight += 1
+            self.record_wait(priority, 0.0)
+            return True
+        else:
+            return False
+
+    def enqueue(self, priority, promise, send):
+        entry = (time.time(), promise, send)
+        self.queues[priority].append(entry)
+        self.queued_total += 1
+        return entry
+
+    def acquire(self, timeout=None, priority=NORMAL):
+        granted = Event()
+
+        with self.cond:
+            if self.take_slot(priority):
+                return True
+
+            entry = self.enqueue(priority, None, granted.set)
+
+        granted.wait(timeout)
+
+        if not granted.is_set():
+            with self.cond:
+                try:
+                    self.queues[priority].remove(entry)
+                    return False
+                except ValueError:
+                    # Got the slot while giving up on it
+                    pass
+
+        return True
+
+    def submit(self, promise, send, priority=NORMAL):
+        with self.cond:
+            if not self.take_slot(priority):
+                self.enqueue(priority, promise, send)
+                return
+
+        send()
+
+    def next_queued(self):
+        # Callers have to hold the lock
+        priority = min((queue[0][0] + self.AGING[priority], priority)
+                       for priority, queue in self.queues.items() if queue)[1]
+
+        queued_at, promise, send = self.queues[priority].popleft()
+        self.record_wait(priority, time.time() - queued_at)
+        self.in_flight += 1
+
+        return send
+
+    def record_wait(self, priority, wait):
+        self.wait_count[priority] += 1
+        self.wait_total[priority] += wait
+        self.wait_max[priority] = max(self.wait_max[priority], wait)
+
+    def release(self, count=1, rate_limited=False):
+        ready = []
+
+        with self.cond:
+            self.in_flight = max(0, self.in_flight - count)
+
+            if rate_limited:
+                self.decrease()
+            else:
+                for i in range(0, count):
+                    self.limit = min(self.max_size, self.limit + 1.0 / self.limit)
+
+            while self.queue_depth and self.has_room():
+                ready.append(self.next_queued())
+
+        for send in ready:
+            send()
+
+    def decrease(self):
+        with self.cond:
+            self.rate_limited += 1
+
+            now = time.time()
+            if now - self.last_decrease < self.cooldown:
+                return
+
+            self.last_decrease = now
+            self.limit = max(self.min_size, self.limit * self.backoff)
+            logger.warning("Rate limited, shrinking in-flight window to {}".format(self.size))
+
+    def reset(self):
+        with self.cond:
+            entries = [entry for queue in self.queues.values() for entry in queue]
+
+            for queue in self.queues.values():
+                queue.clear()
+
+            # Blocked callers are let through, they find the connection gone
+            # and release their slot again.
+            blocked = [send for queued_at, promise, send in entries if promise is None]
+            self.in_flight = len(blocked)
+
+        for send in blocked:
+            send()
+
+        return [promise for queued_at, promise, send in entries if promise is not None]
+
+    def flush(self):
+        # Hand out every queued command at once, regardless of the limit
+        with self.cond:
+            entries = [entry for queue in self.queues.values() for entry in queue]
+
+            for queue in self.queues.values():
+                queue.clear()
+
+            self.in_flight = len(entries)
+
+        return [send for queued_at, promise, send in entries]
+
+    def wait_stats(self):
+        with self.cond:
+            return dict(
+                (name, {
+                    "count": self.wait_count[priority],
+                    "avg_wait": self.wait_total[priority] / self.wait_count[priority]
+                    if self.wait_count[priority] else 0.0,
+                    "max_wait": self.wait_max[priority],
+                    "queued": len(self.queues[priority]),
+                })
+                for priority, name in PRIORITY_NAMES.items()
+            )
+
+    def stats(self):
+        with self.cond:
+            return {
+                "limit": self.size,
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue_depth,
+                "queued_total": self.queued_total,
+                "rate_limited": self.rate_limited,
+                "wait": self.wait_stats(),
+            }
+
+
+class BatchSizer(object):
+    """Picks how many items go into one request of a bulk operation."""
+
+    def __init__(self, size=100, min_size=10, max_size=500, target_latency=2.0, step=10, backoff=0.5):
+        assert 1 <= min_size <= size <= max_size
+        assert 0 < backoff < 1
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.step = step
+        self.backoff = backoff
+
+        self.limit = float(size)
+        self.lock = RLock()
+
+        self.batches = 0
+        self.failed = 0
+
+    @property
+    def size(self):
+        return int(self.limit)
+
+    def record(self, count, latency, failed=False):
+        with self.lock:
+            self.batches += 1
+
+            if failed or latency > self.target_latency:
+                self.failed += failed
+                self.limit = max(self.min_size, self.limit * self.backoff)
+                logger.debug("Shrinking batches to {} items".format(self.size))
+            elif count * 2 >= self.limit:
+                self.limit = min(self.max_size, self.limit + self.step)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": self.size,
+                "batches": self.batches,
+                "failed": self.failed,
+            }
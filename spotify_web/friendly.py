@@ -6,7 +6,8 @@ from urllib2 import urlopen
 from contextlib import closing
 import os.path
 
-from .spotify import SpotifyAPI, SpotifyUtil
+from .login_cache import LoginCache
+from .spotify import SpotifyAPI, SpotifyId, SpotifyUtil
 from tunigoapi import Tunigo
 
 import uuid
@@ -36,17 +37,7 @@ class Cache(object):
         except AttributeError:
             cache = obj.__cache = {}
 
-        arglist = list(args[1:])
-        for i in xrange(0, len(arglist)):
-            if type(arglist[i]) == list:
-                astring = True
-                for item in arglist[i]:
-                    if type(item) != str and type(item) != unicode:
-                        astring = False
-                        break
-                if astring:
-                    arglist[i] = "".join(arglist[i])
-        arglist = tuple(arglist)
+        arglist = tuple(tuple(arg) if type(arg) == list else arg for arg in args[1:])
 
         key = (self.func, arglist, frozenset(kw.items()))
         try:
@@ -87,6 +78,9 @@ class SpotifyObject():
     def getURI(self):
         return SpotifyUtil.gid2uri(self.uri_type, self.obj.gid)
 
+    def getSpotifyId(self):
+        return SpotifyId(self.uri_type, self.obj.gid)
+
 
 class SpotifyMetadataObject(SpotifyObject):
     def __init__(self, spotify, uri=None, obj=None):
@@ -109,21 +103,21 @@ class SpotifyTrack(SpotifyMetadataObject):
 
     @Cache
     def isAvailable(self, country=None):
-        country = self.spotify.api.country if country is None else country
-        new_obj = self.spotify.api.recurse_alternatives(self.obj, country=country)
+        new_obj = self.spotify.api.resolve_alternatives([self.obj], country=country)[0]
         if not new_obj:
             return False
         else:
-            # invalidate cache
-            self._Cache__cache = {}
-
-            if not new_obj.HasField("name"):
-                new_obj = self.spotify.api.metadata_request(SpotifyUtil.gid2uri("track", new_obj.gid))
-            self.old_obj = self.obj
-            self.obj = new_obj
-            self.replaced = True
+            self.replace(new_obj)
             return True
 
+    def replace(self, new_obj):
+        # invalidate cache
+        self._Cache__cache = {}
+
+        self.old_obj = self.obj
+        self.obj = new_obj
+        self.replaced = True
+
     def setStarred(self, starred=True):
         self.spotify.api.set_starred(self.getURI(), starred)
 
@@ -665,55 +659,26 @@ class SpotifyRadioGenre(SpotifyRadio):
 class Spotify():
     AUTOREPLACE_TRACKS = True
 
-    def __init__(self, username, password, use_config=False):
+    def __init__(self, username, password, use_config=False, **kwargs):
+        # Other keyword arguments go to SpotifyAPI
         if use_config:
-            def on_login(success):
-                assert success
-
-                self.store_settings(self.api.settings, self.api.fb_access_token)
+            kwargs.setdefault("login_cache", LoginCache(CONFIG_STORAGE))
 
-            stored_settings = self.load_settings()
-            self.api = SpotifyAPI(
-                on_login,
-                settings=stored_settings.get('settings'),
-                fb_access_token=stored_settings.get('fb_access_token'),
-            )
-        else:
-            self.api = SpotifyAPI()
+        self.api = SpotifyAPI(**kwargs)
 
         self.api.connect(username, password)
 
         self.tunigo = Tunigo()
 
-    def load_settings(self):
-        import cPickle
-
-        if not os.path.exists(CONFIG_STORAGE):
-            return {}
-
-        with open(CONFIG_STORAGE, 'r') as f:
-            return cPickle.load(f) or {}
-
-    def store_settings(self, settings, fb_access_token):
-        assert settings
-
-        import cPickle
-
-        with open(CONFIG_STORAGE, 'w') as f:
-            cPickle.dump(
-                {
-                    'settings': settings,
-                    'fb_access_token': fb_access_token,
-                },
-                f
-            )
-
     def reconnect(self):
         return self.api.reconnect()
 
     def logged_in(self):
         return self.api.is_logged_in
 
+    def healthy(self):
+        return self.api.is_healthy
+
     def logout(self):
         self.api.disconnect()
 
@@ -800,21 +765,20 @@ class Spotify():
             return ", ".join([obj.name for obj in objs])
 
         try:
-            uris = [SpotifyUtil.gid2uri(object_type, obj.gid) for obj in objs]
-        except:
-            uris = SpotifyUtil.gid2uri(object_type, objs.gid)
+            ids = [SpotifyId(object_type, obj.gid) for obj in objs]
+        except TypeError:
+            ids = SpotifyId(object_type, objs.gid)
 
-        return self.objectFromURI(uris, asArray=True)
+        return self.objectFromURI(ids, asArray=True)
 
     def objectFromID(self, object_type, ids):
-        try:
-            uris = [SpotifyUtil.id2uri(object_type, id) for id in ids]
-        except:
-            uris = SpotifyUtil.id2uri(object_type, ids)
+        if hasattr(ids, '__iter__'):
+            ids = [SpotifyId.from_id(object_type, id) for id in ids]
+        else:
+            ids = SpotifyId.from_id(object_type, ids)
 
-        return self.objectFromURI(uris, asArray=True)
+        return self.objectFromURI(ids, asArray=True)
 
-    @Cache
     def objectFromURI(self, uris, asArray=False):
         if not self.logged_in():
             return False
@@ -823,46 +787,61 @@ class Spotify():
         if len(uris) == 0:
             return [] if asArray else None
 
-        uris = [SpotifyUtil.url2uri(uri) or uri for uri in uris]
+        uris = [uri if isinstance(uri, SpotifyId) else SpotifyUtil.url2uri(uri) or uri for uri in uris]
 
-        uri_type = SpotifyUtil.get_uri_type(uris[0])
-        if not uri_type:
-            return [] if asArray else None
-        elif uri_type == "playlist":
-            if len(uris) == 1:
-                results = [SpotifyPlaylist(self, uri=uris[0])]
-            else:
-                thread_results = {}
-                jobs = []
-                for index in range(0, len(uris)):
-                    jobs.append((self, uris[index], thread_results, index))
-
-                def work_function(spotify, uri, results, index):
-                    results[index] = SpotifyPlaylist(spotify, uri=uri)
+        uri_types = [SpotifyUtil.get_uri_type(uri) for uri in uris]
+        found = {}
 
-                Spotify.doWorkerQueue(work_function, jobs)
+        def playlist_job(index):
+            found[index] = SpotifyPlaylist(self, uri=uris[index])
 
-                results = [v for k, v in thread_results.items()]
-
-        elif uri_type in ["track", "album", "artist"]:
-            uris = [uri for uri in uris if not SpotifyUtil.is_local(uri)]
-            objs = self.api.metadata_request(uris)
+        def metadata_job(indexes):
+            # One request for all tracks, albums and artists, the API groups
+            # them by type.
+            objs = self.api.metadata_request([uris[index] for index in indexes])
             objs = [objs] if type(objs) != list else objs
 
-            failed_requests = len([obj for obj in objs if False == obj])
+            failed_requests = len([obj for obj in objs if not obj])
             if failed_requests > 0:
                 print failed_requests, "metadata requests failed"
 
-            objs = [obj for obj in objs if False != obj]
-            if uri_type == "track":
-                tracks = [SpotifyTrack(self, obj=obj) for obj in objs]
-                results = [track for track in tracks if False == self.AUTOREPLACE_TRACKS or track.isAvailable()]
-            elif uri_type == "album":
-                results = [SpotifyAlbum(self, obj=obj) for obj in objs]
-            elif uri_type == "artist":
-                results = [SpotifyArtist(self, obj=obj) for obj in objs]
-        else:
-            return [] if asArray else None
+            # Alternatives for unavailable tracks are resolved for all
+            # tracks at once, with one request for their metadata
+            if self.AUTOREPLACE_TRACKS:
+                tracks = [(index, obj) for index, obj in zip(indexes, objs) if obj and uri_types[index] == "track"]
+                resolved = dict(zip([index for index, obj in tracks],
+                                    self.api.resolve_alternatives([obj for index, obj in tracks])))
+
+            for index, obj in zip(indexes, objs):
+                if not obj:
+                    continue
+
+                uri_type = uri_types[index]
+                if uri_type == "track":
+                    track = SpotifyTrack(self, obj=obj)
+                    if False == self.AUTOREPLACE_TRACKS:
+                        found[index] = track
+                    elif resolved[index]:
+                        track.replace(resolved[index])
+                        found[index] = track
+                elif uri_type == "album":
+                    found[index] = SpotifyAlbum(self, obj=obj)
+                elif uri_type == "artist":
+                    found[index] = SpotifyArtist(self, obj=obj)
+
+        jobs = [(playlist_job, index) for index, uri_type in enumerate(uri_types) if uri_type == "playlist"]
+
+        metadata_indexes = [index for index, uri_type in enumerate(uri_types)
+                            if uri_type in ["track", "album", "artist"]]
+        if metadata_indexes:
+            jobs.append((metadata_job, metadata_indexes))
+
+        if len(jobs) == 1:
+            jobs[0][0](jobs[0][1])
+        elif len(jobs) > 1:
+            Spotify.doWorkerQueue(lambda job, arg: job(arg), jobs)
+
+        results = [found[index] for index in sorted(found)]
 
         if not asArray:
             if len(results) == 1:
@@ -0,0 +1,146 @@
+from threading import Lock
+
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+# How metadata bodies are decoded
+EAGER = "eager"
+LAZY = "lazy"
+SCALARS = "scalars"
+
+scalars_pool = descriptor_pool.DescriptorPool()
+scalars_factory = message_factory.MessageFactory(scalars_pool)
+# message class -> (projection class, names of its fields)
+projections = {}
+projections_lock = Lock()
+
+
+def scalar_projection(message_class):
+    # A message type with only the top-level fields of message_class that
+    # are neither messages nor repeated. Parsing into it lets protobuf skip
+    # everything else, enums become plain integers.
+    projection = projections.get(message_class)
+    if projection is not None:
+        return projection
+
+    with projections_lock:
+        if message_class not in projections:
+            projections[message_class] = build_projection(message_class)
+
+        return projections[message_class]
+
+
+def build_projection(message_class):
+    descriptor = message_class.DESCRIPTOR
+    proto = descriptor_pb2.DescriptorProto()
+    descriptor.CopyToProto(proto)
+
+    fields = []
+    for field in proto.field:
+        if field.type == field.TYPE_MESSAGE or field.label == field.LABEL_REPEATED:
+            continue
+
+        if field.type == field.TYPE_ENUM:
+            enum_type = descriptor.fields_by_name[field.name].enum_type
+            if field.HasField("default_value"):
+                field.default_value = str(enum_type.values_by_name[field.default_value].number)
+
+            field.type = field.TYPE_INT32
+            field.ClearField("type_name")
+
+        fields.append(field)
+
+    del proto.field[:]
+    proto.field.extend(fields)
+    del proto.nested_type[:]
+    del proto.enum_type[:]
+
+    proto.name = descriptor.full_name.replace(".", "_")
+
+    file_proto = descriptor_pb2.FileDescriptorProto()
+    file_proto.name = "scalars/" + proto.name + ".proto"
+    file_proto.package = "scalars"
+    file_proto.message_type.extend([proto])
+    scalars_pool.Add(file_proto)
+
+    projection_class = scalars_factory.GetPrototype(scalars_pool.FindMessageTypeByName("scalars." + proto.name))
+
+    return projection_class, frozenset(field.name for field in fields)
+
+
+class LazyMessage(object):
+    """Protobuf message that is decoded on first attribute access."""
+
+    __slots__ = ("message_class", "body", "message", "scalars", "scalars_only")
+
+    def __init__(self, message_class, body, scalars_only=False):
+        self.message_class = message_class
+        self.body = body
+        self.message = None
+        self.scalars = None
+        self.scalars_only = scalars_only
+
+    @property
+    def decoded(self):
+        return self.message is not None
+
+    def decode(self):
+        if self.message is None:
+            message = self.message_class()
+            message.ParseFromString(self.body)
+
+            self.message = message
+            self.body = None
+            self.scalars = None
+
+        return self.message
+
+    def decode_scalars(self):
+        if self.scalars is None:
+            scalars = scalar_projection(self.message_class)[0]()
+            scalars.ParseFromString(self.body)
+            scalars.DiscardUnknownFields()
+            self.scalars = scalars
+
+        return self.scalars
+
+    def __getattr__(self, name):
+        # Unset slots after copying or unpickling end up here too
+        if name in LazyMessage.__slots__ or name.startswith("__"):
+            raise AttributeError(name)
+
+        if self.message is None and self.scalars_only and name in scalar_projection(self.message_class)[1]:
+            return getattr(self.decode_scalars(), name)
+        else:
+            return getattr(self.decode(), name)
+
+    def __setattr__(self, name, value):
+        if name in LazyMessage.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.decode(), name, value)
+
+    def __reduce__(self):
+        return LazyMessage, (self.message_class, self.SerializeToString(), self.scalars_only)
+
+    def SerializeToString(self):
+        if self.message is None:
+            return self.body
+        else:
+            return self.message.SerializeToString()
+
+    def __eq__(self, other):
+        if isinstance(other, LazyMessage):
+            other = other.decode()
+
+        return self.decode() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __str__(self):
+        return str(self.decode())
+
+    def __repr__(self):
+        return "<LazyMessage {} {}>".format(self.message_class.__name__, "decoded" if self.decoded else "encoded")
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import logging
+from contextlib import contextmanager
+from threading import RLock
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, processes sharing the file may lose updates there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class LoginCache(object):
+    """Persists what auth() learned so the next start can skip it."""
+
+    SESSION_TTL = 3600
+    RESOLVER_TTL = 600
+
+    def __init__(self, path, session_ttl=SESSION_TTL, resolver_ttl=RESOLVER_TTL):
+        self.path = path
+        self.session_ttl = session_ttl
+        self.resolver_ttl = resolver_ttl
+        self.lock = RLock()
+        self.data = None
+        self.mtime = None
+
+    def read(self):
+        # Callers have to hold the lock. Reloads when another process
+        # changed the file.
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+
+        if self.data is None or mtime != self.mtime:
+            self.data = {"sessions": {}, "resolver": {}}
+            self.mtime = mtime
+
+            try:
+                with open(self.path, 'r') as f:
+                    self.data.update(json.load(f))
+            except (IOError, ValueError):
+                # Missing or written by an older version, start over
+                pass
+
+        return self.data
+
+    @contextmanager
+    def update(self):
+        # Yields the current data and writes it back, other processes wait
+        with self.lock:
+            with open(self.path + ".lock", 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+                self.data = None
+                yield self.read()
+                self.write()
+
+    def write(self):
+        # Callers have to hold the lock
+        now = time.time()
+
+        # Only the login type of expired sessions is still useful
+        for username, entry in self.data["sessions"].items():
+            if entry["expires"] <= now:
+                self.data["sessions"][username] = {
+                    "expires": 0,
+                    "settings": None,
+                    "fb_access_token": None,
+                    "login_type": entry.get("login_type"),
+                }
+
+        self.data["resolver"] = dict((key, entry) for key, entry in self.data["resolver"].items()
+                                     if entry["expires"] > now)
+
+        tmp_path = self.path + ".tmp"
+
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.data, f)
+            os.chmod(tmp_path, 0600)
+            os.rename(tmp_path, self.path)
+
+            self.mtime = os.stat(self.path).st_mtime
+        except (IOError, OSError) as e:
+            logger.warning("Could not store login cache in {}: {}".format(self.path, e))
+
+    def load(self, username):
+        with self.lock:
+            entry = self.read()["sessions"].get(username)
+
+        if entry is None or entry["expires"] <= time.time():
+            return None
+
+        return entry
+
+    def save(self, username, settings, fb_access_token=None, login_type="sp"):
+        assert settings
+
+        with self.update() as data:
+            data["sessions"][username] = {
+                "expires": time.time() + self.session_ttl,
+                "settings": settings,
+                "fb_access_token": fb_access_token,
+                "login_type": login_type,
+            }
+
+    def invalidate(self, username):
+        with self.update() as data:
+            entry = data["sessions"].get(username)
+
+            if entry is not None:
+                # Dropped on write, except for what is still useful for the
+                # next auth()
+                entry["expires"] = 0
+
+    def login_type(self, username):
+        with self.lock:
+            entry = self.read()["sessions"].get(username)
+
+        return entry["login_type"] if entry else None
+
+    def load_access_points(self, hostname, version):
+        with self.lock:
+            entry = self.read()["resolver"].get(hostname + "|" + version)
+
+        if entry is None or entry["expires"] <= time.time():
+            return None
+
+        return entry["hostnames"]
+
+    def save_access_points(self, hostname, version, hostnames):
+        with self.update() as data:
+            data["resolver"][hostname + "|" + version] = {
+                "expires": time.time() + self.resolver_ttl,
+                "hostnames": hostnames,
+            }
+            data["last_resolver"] = [hostname, version]
+
+    def last_resolver(self):
+        with self.lock:
+            return self.read().get("last_resolver")
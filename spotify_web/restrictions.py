@@ -0,0 +1,96 @@
+import weakref
+from threading import RLock
+
+from .lazy import LazyMessage
+
+
+class RestrictionIndex(object):
+    """Answers track availability from restrictions compiled to bitmasks."""
+
+    def __init__(self):
+        # country code -> bit
+        self.countries = {}
+        # id(track) -> (weak reference, {catalogue: mask})
+        self.compiled = {}
+        self.lock = RLock()
+
+        self.compilations = 0
+
+    def __len__(self):
+        return len(self.compiled)
+
+    def country_bit(self, country):
+        bit = self.countries.get(country)
+
+        if bit is None:
+            with self.lock:
+                bit = self.countries.setdefault(country, 1 << len(self.countries))
+
+        return bit
+
+    def country_mask(self, countries):
+        mask = 0
+        for i in range(0, len(countries), 2):
+            mask |= self.country_bit(countries[i:i + 2])
+
+        return mask
+
+    def compile(self, track):
+        # Countries listed by a restriction carry over to the ones after it
+        masks = {}
+        allowed = 0
+        forbidden = 0
+
+        for restriction in track.restriction:
+            allowed |= self.country_mask(restriction.countries_allowed)
+            forbidden |= self.country_mask(restriction.countries_forbidden)
+
+            if restriction.HasField("countries_allowed"):
+                available = allowed
+            else:
+                available = allowed | ~forbidden
+
+            for catalogue in restriction.catalogue:
+                masks[catalogue] = masks.get(catalogue, 0) | available
+
+        return masks
+
+    def masks(self, track):
+        if isinstance(track, LazyMessage):
+            track = track.decode()
+
+        key = id(track)
+        entry = self.compiled.get(key)
+
+        if entry is not None and entry[0]() is track:
+            return entry[1]
+
+        masks = self.compile(track)
+
+        with self.lock:
+            self.compiled[key] = (weakref.ref(track, lambda ref: self.forget(key, ref)), masks)
+            self.compilations += 1
+
+        return masks
+
+    def forget(self, key, ref):
+        with self.lock:
+            entry = self.compiled.get(key)
+
+            if entry is not None and entry[0] is ref:
+                del self.compiled[key]
+
+    def available(self, track, country, catalogue):
+        return bool(self.masks(track).get(catalogue, 0) & self.country_bit(country))
+
+    def available_in(self, tracks, country, catalogue):
+        bit = self.country_bit(country)
+        return [bool(self.masks(track).get(catalogue, 0) & bit) for track in tracks]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "tracks": len(self.compiled),
+                "countries": len(self.countries),
+                "compilations": self.compilations,
+            }
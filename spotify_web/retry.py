@@ -0,0 +1,81 @@
+import random
+from threading import RLock
+
+# Error classes a failed command can fall into
+FATAL = "fatal"
+TRANSIENT = "transient"
+RATE_LIMITED = "rate_limited"
+
+
+class RetryPolicy(object):
+    """Decides whether and when a failed command is sent again."""
+
+    DECISIONS = {
+        (8, None): RATE_LIMITED,  # Rate request error
+        (None, 8): RATE_LIMITED,  # rate limited
+        (None, 429): RATE_LIMITED,  # too many requests
+        (None, 408): TRANSIENT,  # timeout
+        (None, 1): TRANSIENT,  # failed to send to backend
+    }
+
+    BASE_DELAY = {
+        TRANSIENT: 0.1,
+        RATE_LIMITED: 1.0,
+    }
+
+    def __init__(self, max_delay=30.0, budget_ratio=0.2, budget_max=20.0, decisions=None):
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_max = budget_max
+        self.budget = budget_max
+        self.decisions = decisions if decisions is not None else self.DECISIONS
+        self.lock = RLock()
+
+        self.retried = 0
+        self.exhausted = 0
+
+    def classify(self, error):
+        # Imported here, spotify.py imports this module
+        from .spotify import SpotifyCommandError, SpotifyDisconnectedError, SpotifyTimeoutError
+
+        if isinstance(error, SpotifyCommandError):
+            for key in ((error.major, error.minor), (None, error.minor), (error.major, None)):
+                if key in self.decisions:
+                    return self.decisions[key]
+            return FATAL
+        elif isinstance(error, SpotifyDisconnectedError):
+            return FATAL
+        elif isinstance(error, SpotifyTimeoutError):
+            return TRANSIENT
+        else:
+            # Failing transforms, as before
+            return TRANSIENT
+
+    def request_started(self):
+        with self.lock:
+            self.budget = min(self.budget_max, self.budget + self.budget_ratio)
+
+    def should_retry(self, error, attempt, retries):
+        if attempt + 1 >= retries or self.classify(error) == FATAL:
+            return False
+
+        with self.lock:
+            if self.budget < 1:
+                self.exhausted += 1
+                return False
+
+            self.budget -= 1
+            self.retried += 1
+            return True
+
+    def delay(self, error, attempt):
+        base = self.BASE_DELAY[self.classify(error)]
+        return random.uniform(0, min(self.max_delay, base * 2 ** attempt))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "budget": self.budget,
+                "retried": self.retried,
+                "exhausted": self.exhausted,
+            }
@@ -0,0 +1,175 @@
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Thread, Event, RLock
+
+from aplus import Promise
+
+from .deadlines import DeadlineScheduler
+from .executors import CallbackThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+def create_session(username, password, **kwargs):
+    # Imported here, friendly pulls in lxml and tunigo
+    from .friendly import Spotify
+    return Spotify(username, password, **kwargs)
+
+
+class SessionManager(object):
+    """Keeps logged in sessions for many accounts."""
+
+    def __init__(self, max_sessions=100, idle_timeout=600, check_interval=30, factory=create_session,
+                 callback_workers=16):
+        assert max_sessions >= 1
+
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.factory = factory
+        self.callback_executor = CallbackThreadPool(callback_workers)
+        self.deadlines = DeadlineScheduler()
+
+        # username -> (session, password digest, last used), least recently used first
+        self.sessions = OrderedDict()
+        self.logins = {}
+        self.lock = RLock()
+
+        self.created = 0
+        self.evicted = 0
+
+        self.stopped = Event()
+        self.sweeper = Thread(target=self.sweep_handler)
+        self.sweeper.daemon = True
+        self.sweeper.start()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @staticmethod
+    def digest(username, password):
+        return hashlib.sha256(username + ":" + password).hexdigest()
+
+    def get(self, username, password):
+        digest = self.digest(username, password)
+
+        with self.lock:
+            entry = self.sessions.pop(username, None)
+
+            if entry is not None:
+                session, session_digest, last_used = entry
+                self.sessions[username] = (session, session_digest, time.time())
+
+                return session if session_digest == digest else None
+
+            login = self.logins.get(username)
+            leader = login is None
+
+            if leader:
+                login = self.logins[username] = Promise()
+
+        if not leader:
+            session, session_digest = login.get()
+
+            if session_digest == digest:
+                return session
+            elif session is None:
+                # Someone else failed with a different password, try ours
+                return self.get(username, password)
+            else:
+                return None
+
+        session = None
+        try:
+            session = self.factory(username, password, callback_executor=self.callback_executor,
+                                   deadline_scheduler=self.deadlines)
+
+            if not session.logged_in():
+                self.close(username, session)
+                session = None
+        finally:
+            evicted = []
+
+            with self.lock:
+                del self.logins[username]
+
+                if session is not None:
+                    self.sessions[username] = (session, digest, time.time())
+                    self.created += 1
+
+                    while len(self.sessions) > self.max_sessions:
+                        evicted.append(self.sessions.popitem(last=False))
+
+            login.fulfill((session, digest))
+            self.logout_all(evicted)
+
+        return session
+
+    def remove(self, username):
+        with self.lock:
+            entry = self.sessions.pop(username, None)
+
+        if entry is not None:
+            self.logout_all([(username, entry)])
+
+    def sweep(self):
+        now = time.time()
+        evicted = []
+
+        with self.lock:
+            for username, (session, digest, last_used) in self.sessions.items():
+                if now - last_used > self.idle_timeout:
+                    logger.debug("Session of {} was idle for {:.0f}s".format(username, now - last_used))
+                elif not session.healthy():
+                    logger.warning("Session of {} stopped answering heartbeats".format(username))
+                else:
+                    continue
+
+                evicted.append((username, self.sessions.pop(username)))
+
+        self.logout_all(evicted)
+
+    def sweep_handler(self):
+        while not self.stopped.wait(self.check_interval):
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Sweeping sessions failed")
+
+    def logout_all(self, entries):
+        for username, (session, digest, last_used) in entries:
+            logger.info("Logging out {}".format(username))
+            self.evicted += 1
+            self.close(username, session)
+
+    @staticmethod
+    def close(username, session):
+        # Sessions are not reused, so their heartbeat thread is stopped too
+        try:
+            session.logout()
+            session.api.shutdown()
+        except Exception:
+            logger.exception("Logging out {} failed".format(username))
+
+    def shutdown(self):
+        self.stopped.set()
+
+        with self.lock:
+            entries = self.sessions.items()
+            self.sessions.clear()
+
+        self.logout_all(entries)
+
+        self.deadlines.stop()
+        self.callback_executor.shutdown()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "logging_in": len(self.logins),
+                "created": self.created,
+                "evicted": self.evicted,
+            }
@@ -5,12 +5,16 @@ import operator
 import binascii
 import base64
 import logging
+import time
+import weakref
+import itertools
+from collections import deque
 from ssl import SSLError
 from threading import Thread, Event, RLock
 
-from aplus import Promise
+from aplus import Promise, listPromise
 
-from random import randint
+from random import randint, uniform
 import uuid
 
 import requests
@@ -21,12 +25,26 @@ import mechanize
 import urllib
 from urlparse import urlparse, parse_qs
 
+from .aps import AccessPointSelector
+from .cache import MetadataCache, NegativeCache
+from .deadlines import DeadlineScheduler
+from .codec import encode_b64, decode_b64, encode_message, decode_message, decode_mget_replies
+from .executors import CallbackThreadPool, run_in_thread
+from .lazy import LazyMessage, EAGER, SCALARS
+from .flow import BatchSizer, InFlightWindow, INTERACTIVE, NORMAL, BULK
+from .restrictions import RestrictionIndex
+from .retry import RetryPolicy
 from .proto import mercury_pb2, metadata_pb2, playlist4changes_pb2, \
     playlist4ops_pb2, playlist4service_pb2, toplist_pb2, bartender_pb2, \
     radio_pb2
 
 
 base62 = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# Lookup tables for converting two base62 digits at a time
+BASE62_PAIRS = [a + b for a in base62 for b in base62]
+BASE62_PAIR_VALUES = dict((pair, i) for i, pair in enumerate(BASE62_PAIRS))
+BASE62_BLOCK = 62 ** 10
+BASE62_MAX = 62 ** 22
 APP_ID = 174829003346
 
 logger = logging.getLogger(__name__)
@@ -52,20 +70,68 @@ class SpotifyTimeoutError(Exception):
         self.message = "Request to Spotify timed out"
 
 
+class MissingMetadata(object):
+    """Takes the place of an item a metadata request could not return."""
+
+    __slots__ = ("id", "status_code", "error")
+
+    def __init__(self, status_code=None, id=None, error=None):
+        self.id = id
+        self.status_code = status_code
+        self.error = error
+
+    def __nonzero__(self):
+        return False
+
+    def __repr__(self):
+        return "MissingMetadata({!r}, status_code={!r})".format(self.id, self.status_code)
+
+
 class SpotifyClient(WebSocketClient):
+    # Assumed round trip time until the first response has been timed
+    DEFAULT_LATENCY = 0.1
+
     def __init__(self, url, protocols=None, extensions=None, heartbeat_freq=None,
                  ssl_options=None, headers=None):
         super(SpotifyClient, self).__init__(url, protocols, extensions, heartbeat_freq, ssl_options, headers)
         self.api_object = None
 
+        self.seq = 0
+        self.cmd_promises = {}
+        self.commands = {}
+        self.sent_at = {}
+        self.deadlines = {}
+        self.latency = None
+
+    @property
+    def in_flight(self):
+        return len(self.cmd_promises)
+
+    @property
+    def load(self):
+        # Expected wait for a new command: everything queued in front of it
+        # plus itself, at the round trip time we have seen so far.
+        latency = self.latency if self.latency is not None else SpotifyClient.DEFAULT_LATENCY
+        return (self.in_flight + 1) * latency
+
+    def track_latency(self, pid):
+        sent_at = self.sent_at.pop(pid, None)
+        if sent_at is None:
+            return
+
+        rtt = time.time() - sent_at
+        self.latency = rtt if self.latency is None else 0.8 * self.latency + 0.2 * rtt
+
+        return rtt
+
     def set_api(self, api):
         self.api_object = api
 
     def opened(self):
-        self.api_object.login()
+        self.api_object.login(self)
 
     def received_message(self, m):
-        self.api_object.recv_packet(m)
+        self.api_object.recv_packet(m, self)
 
     def closed(self, code, message=None):
         self.api_object.disconnect(original_ws=self)
@@ -77,36 +143,87 @@ class SpotifyUtil():
         return binascii.hexlify(gid).rjust(32, "0")
 
     @staticmethod
-    def id2uri(uritype, v):
-        res = []
-        v = int(v, 16)
-        while v > 0:
-            res = [v % 62] + res
-            v /= 62
-        id = ''.join([base62[i] for i in res])
-        return "spotify:" + uritype + ":" + id.rjust(22, "0")
+    def int2base62(v):
+        # v < 62 ** 22 is split into 2 + 10 + 10 digits, the 10 digit blocks
+        # fit into a machine int and are converted two digits at a time.
+        if v >= BASE62_MAX:
+            raise ValueError("Id out of range: {}".format(v))
+
+        high, low = divmod(v, BASE62_BLOCK)
+        top, middle = divmod(high, BASE62_BLOCK)
+        middle, low = int(middle), int(low)
+
+        digits = [BASE62_PAIRS[top]]
+        for block in (middle, low):
+            d4, d5 = divmod(block, 3844)
+            d3, d4 = divmod(d4, 3844)
+            d2, d3 = divmod(d3, 3844)
+            d1, d2 = divmod(d2, 3844)
+            digits += [BASE62_PAIRS[d1], BASE62_PAIRS[d2], BASE62_PAIRS[d3], BASE62_PAIRS[d4], BASE62_PAIRS[d5]]
+
+        return "".join(digits)
 
     @staticmethod
-    def uri2id(uri):
+    def base622int(s):
+        if len(s) > 22:
+            raise ValueError("Invalid base62 id: {}".format(s))
+
+        d = s.rjust(22, "0")
+        pairs = BASE62_PAIR_VALUES
+        try:
+            top = pairs[d[0:2]]
+            middle = (((pairs[d[2:4]] * 3844 + pairs[d[4:6]]) * 3844 + pairs[d[6:8]]) * 3844 +
+                      pairs[d[8:10]]) * 3844 + pairs[d[10:12]]
+            low = (((pairs[d[12:14]] * 3844 + pairs[d[14:16]]) * 3844 + pairs[d[16:18]]) * 3844 +
+                   pairs[d[18:20]]) * 3844 + pairs[d[20:22]]
+        except KeyError:
+            raise ValueError("Invalid base62 id: {}".format(s))
+
+        return (top * BASE62_BLOCK + middle) * BASE62_BLOCK + low
+
+    @staticmethod
+    def uri2base62(uri):
         parts = uri.split(":")
         if len(parts) > 3 and parts[3] == "playlist":
-            s = parts[4]
+            return parts[4]
         else:
-            s = parts[2]
+            return parts[2]
 
-        v = 0
-        for c in s:
-            v = v * 62 + base62.index(c)
-        return hex(v)[2:-1].rjust(32, "0")
+    @staticmethod
+    def id2uri(uritype, v):
+        return "spotify:" + uritype + ":" + SpotifyUtil.int2base62(int(v, 16))
+
+    @staticmethod
+    def uri2id(uri):
+        return "%032x" % SpotifyUtil.base622int(SpotifyUtil.uri2base62(uri))
 
     @staticmethod
     def gid2uri(uritype, gid):
-        id = SpotifyUtil.gid2id(gid)
-        uri = SpotifyUtil.id2uri(uritype, id)
-        return uri
+        return "spotify:" + uritype + ":" + SpotifyUtil.int2base62(int(binascii.hexlify(gid) or "0", 16))
+
+    @staticmethod
+    def uri2gid(uri):
+        return binascii.unhexlify(SpotifyUtil.uri2id(uri))
+
+    @staticmethod
+    def gids2uris(uritype, gids):
+        prefix = "spotify:" + uritype + ":"
+        hexlify = binascii.hexlify
+        int2base62 = SpotifyUtil.int2base62
+        return [prefix + int2base62(int(hexlify(gid) or "0", 16)) for gid in gids]
+
+    @staticmethod
+    def uris2gids(uris):
+        unhexlify = binascii.unhexlify
+        uri2base62 = SpotifyUtil.uri2base62
+        base622int = SpotifyUtil.base622int
+        return [unhexlify("%032x" % base622int(uri2base62(uri))) for uri in uris]
 
     @staticmethod
     def get_uri_type(uri):
+        if isinstance(uri, SpotifyId):
+            return uri.type
+
         uri_parts = uri.split(":")
 
         if len(uri_parts) >= 3 and uri_parts[1] == "local":
@@ -137,6 +254,82 @@ class SpotifyUtil():
         return "spotify:" + url
 
 
+class SpotifyId(object):
+    """Hashable id of a track, album or artist: a type and a 16 byte gid."""
+
+    __slots__ = ("kind", "gid", "__weakref__")
+
+    TYPES = ("track", "album", "artist")
+    KINDS = dict((name, kind) for kind, name in enumerate(TYPES))
+
+    instances = weakref.WeakValueDictionary()
+
+    def __new__(cls, uritype, gid):
+        if uritype not in cls.KINDS:
+            raise ValueError("Unsupported id type: {}".format(uritype))
+        if len(gid) != 16:
+            raise ValueError("Invalid gid: {!r}".format(gid))
+
+        kind = cls.KINDS[uritype]
+        key = (kind, gid)
+
+        instance = cls.instances.get(key)
+        if instance is None:
+            instance = object.__new__(cls)
+            instance.kind = kind
+            instance.gid = gid
+            instance = cls.instances.setdefault(key, instance)
+
+        return instance
+
+    @classmethod
+    def from_uri(cls, uri):
+        parts = uri.split(":")
+        if len(parts) != 3 or parts[0] != "spotify":
+            raise ValueError("Unsupported URI: {}".format(uri))
+
+        return cls(parts[1], binascii.unhexlify("%032x" % SpotifyUtil.base622int(parts[2])))
+
+    @classmethod
+    def from_id(cls, uritype, id):
+        return cls(uritype, binascii.unhexlify(id.rjust(32, "0")))
+
+    @property
+    def type(self):
+        return self.TYPES[self.kind]
+
+    @property
+    def id(self):
+        return binascii.hexlify(self.gid)
+
+    @property
+    def base62(self):
+        return SpotifyUtil.int2base62(int(binascii.hexlify(self.gid), 16))
+
+    @property
+    def uri(self):
+        return "spotify:" + self.TYPES[self.kind] + ":" + self.base62
+
+    def __eq__(self, other):
+        return self is other or \
+            (isinstance(other, SpotifyId) and self.kind == other.kind and self.gid == other.gid)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.gid) ^ self.kind
+
+    def __reduce__(self):
+        return SpotifyId, (self.type, self.gid)
+
+    def __str__(self):
+        return self.uri
+
+    def __repr__(self):
+        return "SpotifyId({!r})".format(self.uri)
+
+
 class SpotifyAPI():
     INIT = 0
     CONNECTING = 1
@@ -144,12 +337,41 @@ class SpotifyAPI():
     DISCONNECTING = 3
     DISCONNECTED = 4
 
-    def __init__(self, login_callback_func=None, settings=None, fb_access_token=None):
+    # Seconds after which a command that got no response is rejected
+    COMMAND_TIMEOUT = 30
+    # Seconds a command held back during a reconnect waits for the session
+    PARKED_TIMEOUT = 60
+
+    HEARTBEAT_INTERVAL = 18
+
+    AUTH_SETTINGS_RX = re.compile("\"(csrftoken|trackingId|referrer|landingURL)\":\"(.*?)\"")
+
+    # Metadata statuses of ids that do not exist, kept in the negative cache
+    MISSING_STATUSES = (404, 410)
+
+    # Restriction catalogue of each account type, guessing at names here,
+    # corrections welcome
+    ACCOUNT_CATALOGUES = {
+        "premium": 1,
+        "unlimited": 1,
+        "free": 0,
+    }
+
+    # Commands besides Mercury GETs that can safely be sent twice
+    IDEMPOTENT_COMMANDS = ("sp/track_uri", "sp/search")
+
+    def __init__(self, login_callback_func=None, settings=None, fb_access_token=None, pool_size=1,
+                 window_size=None, single_flight=True, callback_executor=None, retry_policy=None, batch_sizer=None,
+                 negative_cache=None, metadata_cache=None, metadata_decoding=EAGER, restriction_index=None,
+                 resilient=False, ap_selector=None, login_cache=None, deadline_scheduler=None):
+        assert pool_size >= 1
+
         self.auth_server = "play.spotify.com"
 
         self.logged_in_marker = Event()
         self.heartbeat_marker = Event()
         self.heartbeat_thread = None
+        self.last_heartbeat = None
         self.userid = None
         self.username = None
         self.password = None
@@ -164,14 +386,52 @@ class SpotifyAPI():
 
         self.ws = None
         self.ws_lock = RLock()
-        self.seq = 0
-        self.cmd_promises = {}
+        self.pool = []
+        self.pool_size = pool_size
+        self.login_cache = login_cache
+        self.login_type = None
+        self.login_error = None
+        self.ap_selector = ap_selector or AccessPointSelector(login_cache=login_cache)
+        self.resilient = resilient
+        self.reconnecting = False
+        self.parked = []
+        self.window = InFlightWindow(window_size) if window_size else None
+        self.own_deadlines = deadline_scheduler is None
+        self.deadlines = deadline_scheduler if deadline_scheduler is not None else DeadlineScheduler()
+        self.expired_requests = 0
+        self.late_responses = 0
+
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.batch_sizer = batch_sizer or BatchSizer()
+        self.negative_cache = negative_cache if negative_cache is not None else NegativeCache()
+        self.metadata_cache = metadata_cache if metadata_cache is not None else MetadataCache()
+        self.metadata_decoding = metadata_decoding
+        self.restriction_index = restriction_index if restriction_index is not None else RestrictionIndex()
+
+        self.own_executor = callback_executor is None
+        self.callback_executor = callback_executor or CallbackThreadPool()
+
+        self.single_flight = single_flight
+        self.single_flight_lock = RLock()
+        self.shared_requests = {}
+        self.single_flight_hits = 0
+        self.single_flight_misses = 0
         self.login_callback_func = login_callback_func
 
     @property
     def is_logged_in(self):
         return self.state == SpotifyAPI.CONNECTED
 
+    @property
+    def is_healthy(self):
+        # Logged in and the heartbeat is still answered
+        return self.is_logged_in and self.last_heartbeat is not None and \
+            time.time() - self.last_heartbeat < 3 * self.HEARTBEAT_INTERVAL
+
+    @property
+    def queue_depth(self):
+        return self.window.queue_depth if self.window else 0
+
     def connect(self, username, password, timeout=10):
         with self.ws_lock:
             if self.state == SpotifyAPI.CONNECTED or self.state == SpotifyAPI.CONNECTING:
@@ -181,7 +441,22 @@ class SpotifyAPI():
             else:
                 self.state = SpotifyAPI.CONNECTING
 
+        self.login_error = None
+
+        from_cache = False
+        if not self.settings and self.login_cache:
+            cached = self.login_cache.load(username)
+
+            if cached:
+                logger.debug("Using cached login for {}".format(username))
+                self.settings = cached["settings"]
+                self.fb_access_token = cached["fb_access_token"]
+                self.login_type = cached["login_type"]
+                from_cache = True
+
         if not self.settings and not self.auth(username, password):
+            with self.ws_lock:
+                self.state = SpotifyAPI.DISCONNECTED
             return False
 
         self.username = username
@@ -191,23 +466,149 @@ class SpotifyAPI():
             if self.state is not SpotifyAPI.CONNECTING:
                 return False
 
-            logger.info("Connecting to {}...".format(self.settings["wss"]))
+            # Fall back to the next best access point if the socket cannot be opened
+            urls = [self.settings["wss"]]
+            urls += [url for url in self.settings.get("wss_list", []) if url != self.settings["wss"]]
 
-            try:
-                self.ws = SpotifyClient(self.settings["wss"])
-                self.ws.set_api(self)
-                self.ws.daemon = True
-                self.ws.connect()
-            except:
+            for url in urls:
+                logger.info("Connecting to {}...".format(url))
+
+                try:
+                    self.ws = SpotifyClient(url)
+                    self.ws.set_api(self)
+                    self.ws.daemon = True
+                    self.ws.connect()
+                except:
+                    logger.warning("Could not connect to {}".format(url))
+                    self.ap_selector.demote(url)
+                    self.ws = None
+                    continue
+
+                self.settings["wss"] = url
+                break
+
+            if self.ws is None:
+                self.state = SpotifyAPI.DISCONNECTED
                 return False
 
         if not self.logged_in_marker.wait(timeout=timeout):
             logger.debug("Aborting after unsuccessfully connecting for {} seconds.")
+            self.ap_selector.demote(self.settings["wss"])
+            self.disconnect()
+            return False
+        elif self.login_error is not None:
+            logger.error("Login failed: {}".format(self.login_error.message or type(self.login_error).__name__))
+            self.login_error = None
             self.disconnect()
+
+            if from_cache:
+                logger.info("Cached login for {} was rejected, authenticating again".format(username))
+                self.login_cache.invalidate(username)
+                return self.connect(username, password, timeout)
+
+            if self.login_callback_func:
+                self.login_callback_func(False)
+
             return False
         else:
+            if self.is_logged_in:
+                if self.login_cache and not from_cache:
+                    self.login_cache.save(username, self.settings, self.fb_access_token, self.login_type)
+
+                if self.pool_size > 1:
+                    self.open_pool()
+
             return self.is_logged_in
 
+    def open_pool(self):
+        # Spread the additional sockets over the access points the resolver
+        # gave us, they join the pool once their own login went through.
+        urls = self.settings.get("wss_list") or [self.settings["wss"]]
+
+        for i in range(1, self.pool_size):
+            url = urls[i % len(urls)]
+            logger.info("Opening pooled connection to {}...".format(url))
+
+            with self.ws_lock:
+                if self.state != SpotifyAPI.CONNECTED:
+                    return
+
+                try:
+                    ws = SpotifyClient(url)
+                    ws.set_api(self)
+                    ws.daemon = True
+                    ws.connect()
+                except:
+                    logger.warning("Could not open pooled connection to {}".format(url))
+
+    def pool_login_callback(self, ws, resp):
+        with self.ws_lock:
+            if self.state != SpotifyAPI.CONNECTED or ws.terminated:
+                ws.close()
+                return
+
+            self.pool.append(ws)
+            logger.debug("Pooled connection to {} is ready ({} open)".format(ws.url, len(self.pool)))
+
+    def drop_socket(self, ws):
+        with self.ws_lock:
+            if ws in self.pool:
+                self.pool.remove(ws)
+                logger.warning("Pooled connection to {} dropped with {} requests in flight".format(
+                    ws.url, ws.in_flight))
+
+            pending = self.take_pending(ws)
+
+            if self.window:
+                self.window.release(len(pending))
+
+        self.requeue(pending)
+
+    def take_pending(self, ws):
+        pending = [(ws.cmd_promises[pid],) + ws.commands[pid] for pid in sorted(ws.cmd_promises)]
+
+        ws.cmd_promises = {}
+        ws.commands = {}
+        ws.sent_at = {}
+
+        for entry in ws.deadlines.values():
+            self.deadlines.cancel(entry)
+        ws.deadlines = {}
+
+        return pending
+
+    def is_idempotent(self, name, args):
+        return name in self.IDEMPOTENT_COMMANDS or self.is_mercury_get(name, args)
+
+    def requeue(self, pending):
+        # Commands lost with their socket are sent again in resilient mode when
+        # that is safe, everything else fails.
+        for promise, name, args, timeout, priority in pending:
+            if self.resilient and self.is_idempotent(name, args):
+                self.dispatch(promise, name, args, timeout=timeout, priority=priority)
+            else:
+                self.callback_executor.submit(promise.reject, SpotifyDisconnectedError())
+
+    def select_socket(self):
+        with self.ws_lock:
+            healthy = [ws for ws in self.pool if not ws.terminated]
+
+            if not healthy:
+                return self.ws
+
+            return min(healthy, key=lambda ws: ws.load)
+
+    def pool_stats(self):
+        with self.ws_lock:
+            return [
+                {
+                    "url": ws.url,
+                    "in_flight": ws.in_flight,
+                    "latency": ws.latency,
+                }
+                for ws in self.pool
+            ]
+
     def reconnect(self):
         assert self.username and self.password
 
@@ -215,8 +616,47 @@ class SpotifyAPI():
 
         self.disconnect()
 
+        delay = 1.0
         while not self.connect(self.username, self.password, timeout=10):
-            logger.debug("Unsuccessful login")
+            wait = uniform(delay / 2, delay)
+            logger.debug("Unsuccessful login, trying again in {:.1f} seconds".format(wait))
+
+            # Set on shutdown
+            if self.heartbeat_marker.wait(wait):
+                return False
+
+            delay = min(delay * 2, 60.0)
+
+        return True
+
+    def resume(self):
+        if self.reconnect():
+            self.replay_parked()
+
+    def replay_parked(self):
+        with self.ws_lock:
+            parked, self.parked = self.parked, []
+            self.reconnecting = False
+
+        if parked:
+            logger.info("Replaying {} requests after reconnecting".format(len(parked)))
+
+        for promise, name, args, timeout, priority, deadline in parked:
+            self.deadlines.cancel(deadline)
+            self.dispatch(promise, name, args, timeout=timeout, priority=priority)
+
+    def expire_parked(self, promise):
+        with self.ws_lock:
+            parked = [entry for entry in self.parked if entry[0] is not promise]
+            if len(parked) == len(self.parked):
+                # Replayed in time
+                return
+
+            self.parked = parked
+            self.expired_requests += 1
+
+        logger.warning("Session did not come back in time, giving up on a held back request")
+        self.callback_executor.submit(promise.reject, SpotifyDisconnectedError())
 
     def disconnect(self, clear_settings=False, original_ws=None):
         with self.ws_lock:
@@ -228,23 +668,44 @@ class SpotifyAPI():
                 return
             elif original_ws and self.ws is not original_ws:
                 # Prevent old web socket that disconnects from closing the already opened
-                # new web socket.
+                # new web socket. A pooled socket going away only shrinks the pool.
+                self.drop_socket(original_ws)
                 return
             elif self.state == SpotifyAPI.CONNECTING:
                 # We assume that something went wrong and that we need to start from scratch
                 clear_settings = True
 
+            # The connection went away under us, in resilient mode the session
+            # is brought back and idempotent requests wait for it.
+            lost = self.resilient and original_ws is not None and self.state == SpotifyAPI.CONNECTED
+            if lost:
+                logger.warning("Connection lost, reconnecting")
+                self.reconnecting = True
+
             self.state = SpotifyAPI.DISCONNECTING
 
             logger.debug("Disconnecting...")
 
+            pending = []
+            for ws in set(self.pool + [self.ws]):
+                pending += self.take_pending(ws)
+
+                if ws is not self.ws:
+                    ws.close()
+            self.pool = []
+
             self.ws.close()
             self.ws = None
 
-            self.logged_in_marker = Event()
+            queued = []
+            if self.window:
+                if self.reconnecting:
+                    queued = self.window.flush()
+                else:
+                    for promise in self.window.reset():
+                        promise.reject(SpotifyDisconnectedError())
 
-            self.seq = 0
-            self.cmd_promises = {}
+            self.logged_in_marker = Event()
 
             if clear_settings:
                 self.settings = None
@@ -252,10 +713,34 @@ class SpotifyAPI():
             self.state = SpotifyAPI.DISCONNECTED
             logger.debug("Disconnected")
 
+        self.requeue(pending)
+
+        for send in queued:
+            send()
+
+        if lost:
+            thread = Thread(target=self.resume)
+            thread.daemon = True
+            thread.start()
+
     def shutdown(self):
         logger.debug("Shutting down...")
-        self.disconnect()
         self.heartbeat_marker.set()
+        self.disconnect()
+
+        if self.own_deadlines:
+            self.deadlines.stop()
+
+        with self.ws_lock:
+            parked, self.parked = self.parked, []
+            self.reconnecting = False
+
+        for promise, name, args, timeout, priority, deadline in parked:
+            self.deadlines.cancel(deadline)
+            promise.reject(SpotifyDisconnectedError())
+
+        if self.own_executor:
+            self.callback_executor.shutdown()
 
     @staticmethod
     def get_facebook_token(email, password):
@@ -322,124 +807,128 @@ class SpotifyAPI():
 
         session = requests.session()
 
-        resp = session.get("https://" + self.auth_server, headers=headers)
-        data = resp.text
-
-        # csrftoken
-        rx = re.compile("\"csrftoken\":\"(.*?)\"")
-        r = rx.search(data)
+        # Round trips that do not depend on the login page run concurrently
+        # with it: the resolver for the last known client version and the
+        # Facebook token of accounts that logged in through Facebook before.
+        login_type = self.login_cache.login_type(username) if self.login_cache else None
+        last_resolver = self.login_cache.last_resolver() if self.login_cache else None
 
-        if not r or len(r.groups()) < 1:
-            early_exit("There was a problem authenticating, no auth secret found")
+        prefetched_aps = None
+        if last_resolver:
+            prefetched_aps = run_in_thread(self.ap_selector.resolve, requests.session(), last_resolver[0],
+                                           last_resolver[1], headers)
 
-        secret = r.groups()[0]
+        fb_token = None
+        if login_type == "fb" and not self.fb_access_token:
+            fb_token = run_in_thread(self.get_facebook_token, username, password)
 
-        #trackingID
-        rx = re.compile("\"trackingId\":\"(.*?)\"")
-        r = rx.search(data)
-
-        if not r or len(r.groups()) < 1:
-            early_exit("There was a problem authenticating, no auth trackingId found")
-
-        trackingId = r.groups()[0]
-
-        #referrer
-        rx = re.compile("\"referrer\":\"(.*?)\"")
-        r = rx.search(data)
-
-        if not r or len(r.groups()) < 1:
-            early_exit("There was a problem authenticating, no auth referrer found")
-
-        referrer = r.groups()[0]
-
-        #landingURL
-        rx = re.compile("\"landingURL\":\"(.*?)\"")
-        r = rx.search(data)
-
-        if not r or len(r.groups()) < 1:
-            early_exit("There was a problem authenticating, no auth landingURL found")
-
-        landingURL = r.groups()[0]
-
-        login_payload = {
-            "type": "sp",
-            "username": username,
-            "password": password,
-            "secret": secret,
-            "trackingId": trackingId,
-            "referrer": referrer,
-            "landingURL": landingURL,
-            "cf": "",
-        }
-
-        logger.info("Normal login with payload:\n{}".format(login_payload))
-
-        resp = session.post("https://" + self.auth_server + "/xhr/json/auth.php", data=login_payload, headers=headers)
-        resp_json = resp.json()
-
-        if resp_json["status"] != "OK":
-            # Try facebook login
-            token = self.fb_access_token or self.get_facebook_token(username, password)
-            self.fb_access_token = token
-
-            login_payload = {
-                'type': 'fb',
-                'fbuid': 1659862757,
-                'token': token,
-                'secret': secret,
-                'trackingId': trackingId,
-                "referrer": referrer,
-                'landingURL': landingURL,
-                'cf': '',
-                'f': 'login',
-                's': 'direct',
-            }
+        resp = session.get("https://" + self.auth_server, headers=headers)
 
-            logger.info("Normal login failed, trying Facebook login with payload:\n{}".format(login_payload))
+        # csrftoken, trackingId, referrer and landingURL in a single pass
+        page_settings = {}
+        for key, value in self.AUTH_SETTINGS_RX.findall(resp.text):
+            page_settings.setdefault(key, value)
+
+        for key in ("csrftoken", "trackingId", "referrer", "landingURL"):
+            if key not in page_settings:
+                return early_exit("There was a problem authenticating, no auth {} found".format(key))
+
+        secret = page_settings["csrftoken"]
+        trackingId = page_settings["trackingId"]
+        referrer = page_settings["referrer"]
+        landingURL = page_settings["landingURL"]
+
+        for login_type in (["fb", "sp"] if login_type == "fb" else ["sp", "fb"]):
+            if login_type == "sp":
+                login_payload = {
+                    "type": "sp",
+                    "username": username,
+                    "password": password,
+                    "secret": secret,
+                    "trackingId": trackingId,
+                    "referrer": referrer,
+                    "landingURL": landingURL,
+                    "cf": "",
+                }
+
+                logger.info("Normal login with payload:\n{}".format(login_payload))
+            else:
+                token = self.fb_access_token or (fb_token.get() if fb_token else
+                                                 self.get_facebook_token(username, password))
+                self.fb_access_token = token
+
+                login_payload = {
+                    'type': 'fb',
+                    'fbuid': 1659862757,
+                    'token': token,
+                    'secret': secret,
+                    'trackingId': trackingId,
+                    "referrer": referrer,
+                    'landingURL': landingURL,
+                    'cf': '',
+                    'f': 'login',
+                    's': 'direct',
+                }
+
+                logger.info("Facebook login with payload:\n{}".format(login_payload))
 
             resp = session.post("https://" + self.auth_server + "/xhr/json/auth.php", data=login_payload,
                                 headers=headers)
             resp_json = resp.json()
 
-            if resp_json["status"] != "OK":
+            if resp_json["status"] == "OK":
+                break
+            elif login_type == "fb":
                 self.fb_access_token = None
+        else:
+            return early_exit("There was a problem authenticating, authentication failed: {}".format(resp_json))
 
-                early_exit("There was a problem authenticating, authentication failed: {}".format(resp_json))
+        self.login_type = login_type
+        self.settings = resp_json["config"]
 
-        self.settings = resp.json()["config"]
+        #Get wss settings, fastest access point first
+        wss_hostnames = None
+        resolver = [self.settings["aps"]["resolver"]["hostname"], str(self.settings["version"])]
 
-        #Get wss settings
-        resolver_payload = {
-            "client": "24:0:0:" + str(self.settings["version"])
-        }
-
-        resp = session.get('http://' + self.settings["aps"]["resolver"]["hostname"], params=resolver_payload,
-                           headers=headers)
+        if prefetched_aps and last_resolver == resolver:
+            try:
+                wss_hostnames = prefetched_aps.get()
+            except Exception as e:
+                logger.debug("Prefetching access points failed: {}".format(e))
 
-        resp_json = resp.json()
-        wss_hostname = resp_json["ap_list"][0].split(":")[0]
+        if not wss_hostnames:
+            wss_hostnames = self.ap_selector.access_points(session, self.settings, headers)
 
-        self.settings["wss"] = "wss://" + wss_hostname + "/"
+        self.settings["wss"] = "wss://" + wss_hostnames[0] + "/"
+        self.settings["wss_list"] = ["wss://" + hostname + "/" for hostname in wss_hostnames]
 
         logger.debug(str(self.settings))
 
         return True
 
-    def login(self):
+    def login(self, ws=None):
         logger.info("Logging in")
         credentials = self.settings["credentials"][0].split(":", 2)
         credentials[2] = credentials[2].decode("string_escape")
         # credentials_enc = json.dumps(credentials, separators=(',',':'))
 
-        self.wrap_request("connect", credentials, self.login_callback)
+        if ws is None or ws is self.ws:
+            self.wrap_request("connect", credentials, self.login_callback).done(None, self.login_errback)
+        else:
+            self.send_command("connect", credentials, lambda resp: self.pool_login_callback(ws, resp), ws=ws,
+                              bypass_window=True)
 
     def login_callback(self, resp):
         logger.debug("Login Complete")
         self.user_info_request(self.populate_userdata_callback)
 
+    def login_errback(self, error):
+        self.login_error = error
+        self.logged_in_marker.set()
+
     def populate_userdata_callback(self, resp):
         # Send screen size
-        self.send_command("sp/log", [41, 1, 0, 0, 0, 0])
+        self.send_command("sp/log", [41, 1, 0, 0, 0, 0], bypass_window=True)
 
         self.userid = resp["user"]
         self.country = resp["country"]
@@ -452,7 +941,10 @@ class SpotifyAPI():
         magic = base64.b64encode(resp["catalogue"]) == "cHJlbWl1bQ=="
 
         if magic:
-            self.state = SpotifyAPI.CONNECTED
+            with self.ws_lock:
+                self.state = SpotifyAPI.CONNECTED
+                self.pool = [self.ws]
+                self.last_heartbeat = time.time()
 
             if not self.heartbeat_thread:
                 self.heartbeat_thread = Thread(target=self.heartbeat_handler)
@@ -467,7 +959,7 @@ class SpotifyAPI():
         if self.login_callback_func:
             self.login_callback_func(self.is_logged_in)
 
-    def track_uri(self, track, callback=None, prefix="mp3160"):
+    def track_uri(self, track, callback=None, prefix="mp3160", priority=INTERACTIVE):
         track = self.recurse_alternatives(track)
 
         if not track:
@@ -478,55 +970,19 @@ class SpotifyAPI():
                 return False
 
         args = [prefix, SpotifyUtil.gid2id(track.gid)]
-        return self.wrap_request("sp/track_uri", args, callback)
+        return self.wrap_request("sp/track_uri", args, callback, priority=priority)
 
-    def is_track_available(self, track, country):
-        allowed_countries = []
-        forbidden_countries = []
-        available = False
-
-        for restriction in track.restriction:
-            allowed_str = restriction.countries_allowed
-            allowed_countries += [allowed_str[i:i + 2] for i in range(0, len(allowed_str), 2)]
-
-            forbidden_str = restriction.countries_forbidden
-            forbidden_countries += [forbidden_str[i:i + 2] for i in range(0, len(forbidden_str), 2)]
-
-            allowed = not restriction.HasField("countries_allowed") or country in allowed_countries
-            forbidden = self.country in forbidden_countries and len(forbidden_countries) > 0
-
-            if country in allowed_countries and country in forbidden_countries:
-                allowed = True
-                forbidden = False
-
-            # guessing at names here, corrections welcome
-            account_type_map = {
-                "premium": 1,
-                "unlimited": 1,
-                "free": 0
-            }
-
-            applicable = account_type_map[self.account_type] in restriction.catalogue
-
-            # enable this to help debug restriction issues
-            if False:
-                print(restriction)
-                print(allowed_countries)
-                print(forbidden_countries)
-                print("allowed: " + str(allowed))
-                print("forbidden: " + str(forbidden))
-                print("applicable: " + str(applicable))
-
-            available = True == allowed and False == forbidden and True == applicable
-            if available:
-                break
+    @property
+    def catalogue(self):
+        return self.ACCOUNT_CATALOGUES.get(self.account_type, 0)
 
-        if available:
-            logger.info(SpotifyUtil.gid2uri("track", track.gid) + " is available!")
-        else:
-            logger.info(SpotifyUtil.gid2uri("track", track.gid) + " is NOT available!")
+    def is_track_available(self, track, country):
+        return self.restriction_index.available(track, country, self.catalogue)
 
-        return available
+    def available_in(self, tracks, country=None):
+        # Availability of a whole list of tracks, in order
+        country = self.country if country is None else country
+        return self.restriction_index.available_in(tracks, country, self.catalogue)
 
     def recurse_alternatives(self, track, country=None):
         country = self.country if country is None else country
@@ -535,14 +991,38 @@ class SpotifyAPI():
         else:
             for alternative in track.alternative:
                 if self.is_track_available(alternative, country):
+                    logger.debug("Replacing unavailable track {} with {}".format(
+                        SpotifyUtil.gid2uri("track", track.gid), SpotifyUtil.gid2uri("track", alternative.gid)))
                     return alternative
             return False
 
+    def resolve_alternatives(self, tracks, country=None, priority=NORMAL):
+        # recurse_alternatives for a list of tracks. Alternatives only carry
+        # a gid and restrictions, the ones that get picked are fetched with
+        # one metadata request for the whole list.
+        country = self.country if country is None else country
+        resolved = [track if available else self.recurse_alternatives(track, country)
+                    for track, available in zip(tracks, self.available_in(tracks, country))]
+
+        bare = [index for index, track in enumerate(resolved)
+                if track and track is not tracks[index] and not track.HasField("name")]
+
+        if bare:
+            # Not metadata_request, which is a coroutine on AsyncSpotifyAPI
+            ids, promise = self.metadata_items([SpotifyId("track", resolved[index].gid) for index in bare], priority)
+            objs = promise.get()
+
+            # Keep the bare alternative if its metadata could not be fetched
+            for index, obj in zip(bare, objs):
+                resolved[index] = obj or resolved[index]
+
+        return resolved
+
     def generate_multiget_args(self, metadata_type, requests):
         args = [0]
 
         if len(requests.request) == 1:
-            req = base64.encodestring(requests.request[0].SerializeToString())
+            req = encode_message(requests.request[0])
             args.append(req)
         else:
             header = mercury_pb2.MercuryRequest()
@@ -550,72 +1030,260 @@ class SpotifyAPI():
             header.uri = "hm://metadata/" + metadata_type + "s"
             header.content_type = "vnd.spotify/mercury-mget-request"
 
-            header_str = base64.encodestring(header.SerializeToString())
-            req = base64.encodestring(requests.SerializeToString())
+            header_str = encode_message(header)
+            req = encode_message(requests)
             args.extend([header_str, req])
 
         return args
 
-    def metadata_request(self, uris, callback=None):
-        mercury_requests = mercury_pb2.MercuryMultiGetRequest()
-
-        if type(uris) != list:
+    def metadata_request(self, uris, callback=None, priority=NORMAL, batch_size=None):
+        # Lists of URIs or SpotifyIds give a list of the same length, items
+        # that could not be fetched are MissingMetadata.
+        single = type(uris) != list
+        if single:
             uris = [uris]
 
-        for uri in uris:
-            uri_type = SpotifyUtil.get_uri_type(uri)
-            if uri_type == "local":
-                logger.warning("Track with URI " + uri + " is a local track, we can't request metadata, skipping")
+        ids, promise = self.metadata_items(uris, priority, batch_size)
+
+        def finish(items):
+            if single:
+                if isinstance(items[0], MissingMetadata) and items[0].error is not None:
+                    raise items[0].error
+
+                return items[0]
+            else:
+                return items
+
+        return self.settle(promise.then(finish), callback)
+
+    def iter_metadata(self, uris, priority=BULK, batch_size=None, window=2, cache=False):
+        # Yields a (uri, item) pair for every URI or SpotifyId in order, as
+        # the batches arrive. uris may be any iterable, at most window
+        # batches are requested ahead of the consumer so memory stays
+        # bounded by the batch size rather than the number of URIs. Fetched
+        # items are only kept in the metadata cache with cache=True.
+        assert window >= 1
+
+        uris = iter(uris)
+        batch_size = batch_size or self.batch_sizer.size
+        inflight = deque()
+
+        while True:
+            while len(inflight) < window:
+                batch = list(itertools.islice(uris, batch_size))
+                if not batch:
+                    break
+
+                inflight.append((batch, self.metadata_items(batch, priority, batch_size, cache)[1]))
+
+            if not inflight:
+                return
+
+            batch, promise = inflight.popleft()
+            for pair in zip(batch, promise.get()):
+                yield pair
+
+    def metadata_items(self, uris, priority=NORMAL, batch_size=None, cache=True):
+        # Returns the SpotifyIds of the URIs, None for local tracks, and a
+        # promise of their items that never rejects. Fetched items are only
+        # stored in the metadata cache with cache=True.
+        ids = []
+        items = [None] * len(uris)
+        # Expired objects found in the cache, kept for revalidation
+        stale = {}
+        etags = [None] * len(uris)
+        pending = []
+
+        for index, uri in enumerate(uris):
+            if not isinstance(uri, SpotifyId):
+                if SpotifyUtil.is_local(uri):
+                    logger.warning("Track with URI " + uri + " is a local track, we can't request metadata, skipping")
+                    ids.append(None)
+                    items[index] = MissingMetadata()
+                    continue
+
+                uri = SpotifyId.from_uri(uri)
+
+            ids.append(uri)
+
+            status_code = self.negative_cache.get(uri)
+            if status_code is not None:
+                items[index] = MissingMetadata(status_code, uri)
                 continue
 
-            id = SpotifyUtil.uri2id(uri)
+            pending.append(index)
+
+        # Expired objects are revalidated with their etag
+        cached = self.metadata_cache.lookup_many([ids[index] for index in pending])
+        if cached:
+            uncached = []
+
+            for index in pending:
+                entry = cached.get(ids[index])
+
+                if entry is not None:
+                    obj, etags[index], fresh = entry
+
+                    if fresh:
+                        items[index] = obj
+                        continue
+
+                    stale[index] = obj
+
+                uncached.append(index)
+
+            pending = uncached
+
+        batch_size = batch_size or self.batch_sizer.size
+
+        # Multi-gets are per type, mixed requests get one per type. Large
+        # requests are split up, the batches go out concurrently as far as
+        # the in-flight window allows and are put back together in order.
+        positions = {}
+        for index in pending:
+            positions.setdefault(ids[index].kind, []).append(index)
+
+        batches = []
+        for indexes in positions.values():
+            batches += [indexes[i:i + batch_size] for i in range(0, len(indexes), batch_size)]
+
+        promises = [self.metadata_batch([ids[index] for index in batch], priority, [etags[index] for index in batch])
+                    for batch in batches]
+
+        def merge(results):
+            fetched = []
+            revalidated = []
+
+            for batch, replies in zip(batches, results):
+                for index, (reply, item) in zip(batch, replies):
+                    if isinstance(item, MissingMetadata) and item.status_code == 304 and index in stale:
+                        item = stale[index]
+                        revalidated.append((ids[index], item, etags[index], reply))
+                    elif item:
+                        fetched.append((ids[index], item, reply))
+
+                    items[index] = item
+
+            self.metadata_cache.refresh_many(revalidated)
+
+            if cache:
+                self.metadata_cache.store_many(fetched)
+
+            for index in pending:
+                item = items[index]
+
+                if isinstance(item, MissingMetadata):
+                    item.id = ids[index]
 
+                    if item.status_code in self.MISSING_STATUSES:
+                        self.negative_cache.add(item.id, item.status_code)
+
+            return items
+
+        return ids, listPromise(promises).then(merge)
+
+    def metadata_args(self, ids, etags=None):
+        mercury_requests = mercury_pb2.MercuryMultiGetRequest()
+
+        for index, id in enumerate(ids):
             mercury_request = mercury_pb2.MercuryRequest()
             mercury_request.body = "GET"
-            mercury_request.uri = "hm://metadata/" + uri_type + "/" + id
+            mercury_request.uri = "hm://metadata/" + id.type + "/" + id.id
+
+            if etags and etags[index]:
+                mercury_request.etag = etags[index]
 
             mercury_requests.request.extend([mercury_request])
 
-        args = self.generate_multiget_args(SpotifyUtil.get_uri_type(uris[0]), mercury_requests)
+        return self.generate_multiget_args(ids[0].type, mercury_requests)
+
+    def metadata_batch(self, ids, priority=NORMAL, etags=None):
+        # Resolves to a (MercuryReply, item) pair per id and never rejects,
+        # the items of a failed batch are MissingMetadata
+        result = Promise()
+
+        def fulfilled(result_replies):
+            multi, replies = result_replies
+            self.batch_sizer.record(len(ids), promise.rtt or 0.0)
+            result.fulfill(replies + [(None, MissingMetadata()) for i in range(len(replies), len(ids))])
+
+        def rejected(error):
+            if len(ids) == 1 and isinstance(error, SpotifyCommandError) and error.minor in self.MISSING_STATUSES:
+                # A plain GET of an id that does not exist
+                result.fulfill([(None, MissingMetadata(error.minor))])
+                return
+
+            logger.warning("Metadata request for {} items failed: {!r}".format(len(ids), error))
+            self.batch_sizer.record(len(ids), 0.0, failed=True)
+            result.fulfill([(None, MissingMetadata(error=error)) for id in ids])
+
+        promise = self.retrying_promise("sp/hm_b64", self.metadata_args(ids, etags), self.parse_metadata_batch,
+                                        priority=priority)
+        promise.done(fulfilled, rejected)
 
-        return self.wrap_request("sp/hm_b64", args, callback, self.parse_metadata)
+        return result
 
     @staticmethod
     def parse_metadata(resp):
-        header = mercury_pb2.MercuryReply()
-        header.ParseFromString(base64.decodestring(resp[0]))
+        multi, replies = SpotifyAPI.parse_metadata_replies(resp)
 
-        if header.status_message == "vnd.spotify/mercury-mget-reply":
-            if len(resp) < 2:
-                return False
+        if not multi:
+            return replies[0][1]
+        elif not replies:
+            return False
+        else:
+            return [item for reply, item in replies]
 
-            mget_reply = mercury_pb2.MercuryMultiGetReply()
-            mget_reply.ParseFromString(base64.decodestring(resp[1]))
-            items = []
+    def parse_metadata_batch(self, resp):
+        # A bound method rather than a lambda, transforms are part of the
+        # single-flight key
+        return self.parse_metadata_replies(resp, self.metadata_decoding)
 
-            for reply in mget_reply.reply:
-                if reply.status_code != 200:
-                    continue
+    @staticmethod
+    def parse_metadata_replies(resp, decoding=EAGER):
+        # Returns whether this was a multi-get and a (MercuryReply, item) pair
+        # for every requested item, in request order
+        header = decode_message(mercury_pb2.MercuryReply, resp[0])
 
-                item = SpotifyAPI.parse_metadata_item(reply.content_type, reply.body)
-                items.append(item)
+        if header.status_message == "vnd.spotify/mercury-mget-reply":
+            if len(resp) < 2:
+                return True, []
 
-            return items
+            return True, [(reply, SpotifyAPI.parse_metadata_reply(reply, reply.content_type, reply.body, decoding))
+                          for reply in decode_mget_replies(resp[1])]
+        else:
+            # Keeps the raw body with the reply, like the multi-get replies
+            header.body = decode_b64(resp[1]) if len(resp) > 1 else ""
+            body = header.body
+            return False, [(header, SpotifyAPI.parse_metadata_reply(header, header.status_message, body, decoding))]
+
+    @staticmethod
+    def parse_metadata_reply(reply, content_type, body, decoding=EAGER):
+        # Replies that did not bring an item, including 304 Not Modified,
+        # become MissingMetadata
+        if reply.HasField("status_code") and reply.status_code != 200:
+            return MissingMetadata(reply.status_code)
         else:
-            return SpotifyAPI.parse_metadata_item(header.status_message, base64.decodestring(resp[1]))
+            return SpotifyAPI.parse_metadata_item(content_type, body, decoding)
 
     @staticmethod
-    def parse_metadata_item(content_type, body):
+    def parse_metadata_item(content_type, body, decoding=EAGER):
+        # LAZY and SCALARS give a LazyMessage that keeps the body until a
+        # field is read, SCALARS then only decodes the top-level scalars
         if content_type == "vnd.spotify/metadata-album":
-            obj = metadata_pb2.Album()
+            message_class = metadata_pb2.Album
         elif content_type == "vnd.spotify/metadata-artist":
-            obj = metadata_pb2.Artist()
+            message_class = metadata_pb2.Artist
         elif content_type == "vnd.spotify/metadata-track":
-            obj = metadata_pb2.Track()
+            message_class = metadata_pb2.Track
         else:
             logger.error("Unrecognised metadata type " + content_type)
             return False
 
+        if decoding != EAGER:
+            return LazyMessage(message_class, body, scalars_only=decoding == SCALARS)
+
+        obj = message_class()
         obj.ParseFromString(body)
 
         return obj
@@ -643,7 +1311,7 @@ class SpotifyAPI():
                 return False
             mercury_request.uri = "hm://socialgraph/suggestions/topplaylists"
 
-        req = base64.encodestring(mercury_request.SerializeToString())
+        req = encode_message(mercury_request)
 
         args = [0, req]
 
@@ -652,7 +1320,7 @@ class SpotifyAPI():
     @staticmethod
     def parse_toplist(resp):
         obj = toplist_pb2.Toplist()
-        res = base64.decodestring(resp[1])
+        res = decode_b64(resp[1])
         obj.ParseFromString(res)
         return obj
 
@@ -660,7 +1328,7 @@ class SpotifyAPI():
         mercury_request = mercury_pb2.MercuryRequest()
         mercury_request.body = "GET"
         mercury_request.uri = "hm://bartender/stories/skip/0/take/50"
-        req = base64.encodestring(mercury_request.SerializeToString())
+        req = encode_message(mercury_request)
 
         args = [0, req]
         return self.wrap_request("sp/hm_b64", args, callback, self.parse_discover)
@@ -670,7 +1338,7 @@ class SpotifyAPI():
         obj = bartender_pb2.StoryList()
 
         try:
-            res = base64.decodestring(resp[1])
+            res = decode_b64(resp[1])
             obj.ParseFromString(res)
         except Exception as e:
             logger.error(
@@ -683,7 +1351,7 @@ class SpotifyAPI():
         mercury_request = mercury_pb2.MercuryRequest()
         mercury_request.body = "GET"
         mercury_request.uri = "hm://radio/stations"
-        req = base64.encodestring(mercury_request.SerializeToString())
+        req = encode_message(mercury_request)
 
         args = [0, req]
         return self.wrap_request("sp/hm_b64", args, callback, self.parse_radio_stations)
@@ -692,7 +1360,7 @@ class SpotifyAPI():
     def parse_radio_stations(resp):
         obj = radio_pb2.StationList()
         try:
-            res = base64.decodestring(resp[1])
+            res = decode_b64(resp[1])
             obj.ParseFromString(res)
             return obj
         except Exception as e:
@@ -704,7 +1372,7 @@ class SpotifyAPI():
         mercury_request = mercury_pb2.MercuryRequest()
         mercury_request.body = "GET"
         mercury_request.uri = "hm://radio/genres/"
-        req = base64.encodestring(mercury_request.SerializeToString())
+        req = encode_message(mercury_request)
 
         args = [0, req]
         return self.wrap_request("sp/hm_b64", args, callback, self.parse_radio_genres)
@@ -713,7 +1381,7 @@ class SpotifyAPI():
     def parse_radio_genres(resp):
         obj = radio_pb2.GenreList()
         try:
-            res = base64.decodestring(resp[1])
+            res = decode_b64(resp[1])
             obj.ParseFromString(res)
             return obj
         except Exception as e:
@@ -735,12 +1403,12 @@ class SpotifyAPI():
         radio_request.length = num_tracks
         radio_request.stationId = stationId
         radio_request.uris.append(stationUri)
-        req_args = base64.encodestring(radio_request.SerializeToString())
+        req_args = encode_message(radio_request)
 
         mercury_request = mercury_pb2.MercuryRequest()
         mercury_request.body = "GET"
         mercury_request.uri = "hm://radio/"
-        req = base64.encodestring(mercury_request.SerializeToString())
+        req = encode_message(mercury_request)
 
         args = [0, req, req_args]
         return self.wrap_request("sp/hm_b64", args, callback, self.parse_radio_tracks)
@@ -749,7 +1417,7 @@ class SpotifyAPI():
     def parse_radio_tracks(resp):
         obj = radio_pb2.Tracks()
         try:
-            res = base64.decodestring(resp[1])
+            res = decode_b64(resp[1])
             obj.ParseFromString(res)
             return obj
         except Exception as e:
@@ -764,13 +1432,13 @@ class SpotifyAPI():
         mercury_request = mercury_pb2.MercuryRequest()
         mercury_request.body = "GET"
         mercury_request.uri = "hm://playlist/user/" + user + "/rootlist?from=" + str(fromnum) + "&length=" + str(num)
-        req = base64.encodestring(mercury_request.SerializeToString())
+        req = encode_message(mercury_request)
 
         args = [0, req]
 
         return self.wrap_request("sp/hm_b64", args, callback, self.parse_playlist)
 
-    def playlist_request(self, uri, fromnum=0, num=100, callback=None):
+    def playlist_request(self, uri, fromnum=0, num=100, callback=None, priority=NORMAL):
         # mercury_requests = mercury_pb2.MercuryRequest()
 
         playlist = uri[8:].replace(":", "/")
@@ -778,16 +1446,16 @@ class SpotifyAPI():
         mercury_request.body = "GET"
         mercury_request.uri = "hm://playlist/" + playlist + "?from=" + str(fromnum) + "&length=" + str(num)
 
-        req = base64.encodestring(mercury_request.SerializeToString())
+        req = encode_message(mercury_request)
         args = [0, req]
 
-        return self.wrap_request("sp/hm_b64", args, callback, self.parse_playlist)
+        return self.wrap_request("sp/hm_b64", args, callback, self.parse_playlist, priority=priority)
 
     @staticmethod
     def parse_playlist(resp):
         obj = playlist4changes_pb2.ListDump()
         try:
-            res = base64.decodestring(resp[1])
+            res = decode_b64(resp[1])
             obj.ParseFromString(res)
             return obj
         except:
@@ -811,14 +1479,14 @@ class SpotifyAPI():
         mercury_request.body = "GET"
         mercury_request.uri = "hm://collection-web/v1/" + self.userid + "/" + action + extras
 
-        req = base64.encodestring(mercury_request.SerializeToString())
+        req = encode_message(mercury_request)
         args = [0, req]
 
         return self.wrap_request("sp/hm_b64", args, callback, self.parse_my_music)
 
     @staticmethod
     def parse_my_music(resp):
-        return json.loads(base64.decodestring(resp[1]))
+        return json.loads(decode_b64(resp[1]))
 
     def playlist_op_track(self, playlist_uri, track_uri, op, callback=None):
         playlist = playlist_uri.split(":")
@@ -836,8 +1504,9 @@ class SpotifyAPI():
         mercury_request = mercury_pb2.MercuryRequest()
         mercury_request.body = op
         mercury_request.uri = "hm://playlist/user/" + user + "/" + playlist_id + "?syncpublished=1"
-        req = base64.encodestring(mercury_request.SerializeToString())
-        args = [0, req, base64.encodestring(track_uri)]
+        req = encode_message(mercury_request)
+        track_uri = track_uri.uri if isinstance(track_uri, SpotifyId) else track_uri
+        args = [0, req, encode_b64(track_uri)]
         return self.wrap_request("sp/hm_b64", args, callback)
 
     def playlist_add_track(self, playlist_uri, track_uri, callback=None):
@@ -857,7 +1526,7 @@ class SpotifyAPI():
         mercury_request.body = op
         mercury_request.uri = "hm://" + path
 
-        req = base64.encodestring(mercury_request.SerializeToString())
+        req = encode_message(mercury_request)
 
         op = playlist4ops_pb2.Op()
         if optype == "update":
@@ -871,7 +1540,7 @@ class SpotifyAPI():
         mercury_request_payload = mercury_pb2.MercuryRequest()
         mercury_request_payload.uri = op.SerializeToString()
 
-        payload = base64.encodestring(mercury_request_payload.SerializeToString())
+        payload = encode_message(mercury_request_payload)
 
         args = [0, req, payload]
         return self.wrap_request("sp/hm_b64", args, callback, self.new_playlist_callback)
@@ -891,15 +1560,15 @@ class SpotifyAPI():
     def new_playlist_callback(self, data):
         try:
             reply = playlist4service_pb2.CreateListReply()
-            reply.ParseFromString(base64.decodestring(data[1]))
+            reply.ParseFromString(decode_b64(data[1]))
         except:
             return False
 
         mercury_request = mercury_pb2.MercuryRequest()
         mercury_request.body = "ADD"
         mercury_request.uri = "hm://playlist/user/" + self.userid + "/rootlist?add_first=1&syncpublished=1"
-        req = base64.encodestring(mercury_request.SerializeToString())
-        args = [0, req, base64.encodestring(reply.uri)]
+        req = encode_message(mercury_request)
+        args = [0, req, encode_b64(reply.uri)]
 
         self.send_command("sp/hm_b64", args)
 
@@ -931,7 +1600,9 @@ class SpotifyAPI():
         return self.wrap_request("sp/user_info", [], callback)
 
     def heartbeat(self):
-        self.send_command("sp/echo", "h")
+        # Every pooled socket needs its own keep-alive
+        for ws in self.pool[:] or [None]:
+            self.send_command("sp/echo", "h", ws=ws, bypass_window=True)
 
     def send_track_end(self, lid, track_uri, ms_played, callback=None):
         ms_played = int(ms_played)
@@ -978,85 +1649,286 @@ class SpotifyAPI():
                 referrer_version, referrer_vendor]
         return self.wrap_request("sp/track_progress", args, callback)
 
-    def send_command(self, name, args=None, callback=None):
+    def send_command(self, name, args=None, callback=None, ws=None, block=False, timeout=None,
+                     bypass_window=False, priority=NORMAL):
+        return self.command_promise(name, args, callback, ws, block, timeout, bypass_window, priority)
+
+    def command_promise(self, name, args=None, callback=None, ws=None, block=False, timeout=None,
+                        bypass_window=False, priority=NORMAL):
         promise = Promise()
 
-        msg = {
-            "name": name,
-            "id": str(self.seq),
-            "args": args or []
-        }
+        if callback:
+            promise.addCallback(callback)
 
-        msg_enc = json.dumps(msg, separators=(',', ':'))
+        self.dispatch(promise, name, args, ws, block, timeout, bypass_window, priority)
 
+        return promise
+
+    def dispatch(self, promise, name, args, ws=None, block=False, timeout=None, bypass_window=False,
+                 priority=NORMAL):
+        if self.window is None:
+            self.transmit(promise, name, args, ws, timeout, priority)
+        elif bypass_window:
+            self.window.admit()
+            self.transmit(promise, name, args, ws, timeout, priority)
+        elif block:
+            if not self.window.acquire(timeout, priority):
+                promise.reject(SpotifyTimeoutError())
+                return
+
+            self.transmit(promise, name, args, ws, timeout, priority)
+        else:
+            self.window.submit(promise, lambda: self.transmit(promise, name, args, ws, timeout, priority), priority)
+
+    def transmit(self, promise, name, args, ws=None, timeout=None, priority=NORMAL):
         try:
             with self.ws_lock:
+                if self.reconnecting and self.state != SpotifyAPI.CONNECTED and self.is_idempotent(name, args):
+                    # Held back until the session is back
+                    if self.window:
+                        self.window.release()
+                    deadline = self.deadlines.schedule(self.PARKED_TIMEOUT, self.expire_parked, promise)
+                    self.parked.append((promise, name, args, timeout, priority, deadline))
+                    return
+
                 if self.ws is None or self.state == SpotifyAPI.DISCONNECTED:
-                    return Promise.rejected(SpotifyDisconnectedError())
+                    if self.window:
+                        self.window.release()
+                    promise.reject(SpotifyDisconnectedError())
+                    return
+
+                ws = ws or self.select_socket()
+                pid = ws.seq
 
-                pid = self.seq
+                msg = {
+                    "name": name,
+                    "id": str(pid),
+                    "args": args or []
+                }
 
-                if callback:
-                    promise.addCallback(callback)
+                msg_enc = json.dumps(msg, separators=(',', ':'))
 
-                self.cmd_promises[pid] = promise
-                self.seq += 1
+                ws.cmd_promises[pid] = promise
+                ws.commands[pid] = (name, args, timeout, priority)
+                ws.sent_at[pid] = time.time()
+                ws.seq += 1
 
-                self.ws.send(msg_enc)
+                # Before sending, the response may arrive before send() returns
+                ws.deadlines[pid] = self.deadlines.schedule(timeout or self.COMMAND_TIMEOUT, self.expire_command,
+                                                            ws, pid, promise)
+
+                ws.send(msg_enc)
 
                 logger.debug("Sent PID({}) with msg: {}".format(pid, msg_enc))
         except (SSLError, StreamClosed) as e:
             logger.error("SSL error ({}), attempting to continue".format(e))
-            promise.rejected(SpotifyDisconnectedError())
+            self.pop_promise(ws, pid)
+            if ws is not self.ws:
+                self.drop_socket(ws)
+            promise.reject(SpotifyDisconnectedError())
+
+    def expire_command(self, ws, pid, promise):
+        with self.ws_lock:
+            if ws.cmd_promises.get(pid) is not promise:
+                # Answered in time
+                return
+
+            self.pop_promise(ws, pid)
+            self.expired_requests += 1
+
+        logger.warning("PID({}) got no response in time, giving up".format(pid))
+        self.callback_executor.submit(promise.reject, SpotifyTimeoutError())
+
+    def pop_promise(self, ws, pid, rate_limited=False):
+        promise = ws.cmd_promises.pop(pid, None)
+        if promise is None:
+            return None
+
+        command = ws.commands.pop(pid, None)
+        rtt = ws.track_latency(pid)
+
+        deadline = ws.deadlines.pop(pid, None)
+        if deadline is not None:
+            self.deadlines.cancel(deadline)
+        # Time from sending to the response, without queueing or retries
+        promise.rtt = rtt
+
+        if rtt is not None and command is not None and command[0] == "sp/echo":
+            self.last_heartbeat = time.time()
+            self.ap_selector.observe(ws.url, rtt)
+
+        if self.window:
+            self.window.release(rate_limited=rate_limited)
 
         return promise
 
-    def wrap_request(self, command, args, callback=None, transform=None, retries=3, timeout=10):
+    @staticmethod
+    def is_mercury_get(command, args):
+        if command != "sp/hm_b64" or not args or len(args) < 2:
+            return False
+
+        header = mercury_pb2.MercuryRequest()
+        try:
+            header.ParseFromString(decode_b64(args[1]))
+        except Exception:
+            return False
+
+        # The request method travels in the body field
+        return header.body == "GET"
+
+    def request_promise(self, command, args, transform=None, timeout=None, block=False, priority=NORMAL):
+        if not self.single_flight or not self.is_mercury_get(command, args):
+            return self.transformed(self.command_promise(command, args, block=block, timeout=timeout,
+                                                         priority=priority), transform)
+
+        # Concurrent reads of the same resource share one round trip, every
+        # caller gets the same parsed result.
+        key = (command, json.dumps(args, separators=(',', ':')), transform)
+
+        with self.single_flight_lock:
+            shared = self.shared_requests.get(key)
+
+            if shared is not None:
+                self.single_flight_hits += 1
+                return shared
+
+            self.single_flight_misses += 1
+            shared = self.shared_requests[key] = Promise()
+
+        def forget(_):
+            with self.single_flight_lock:
+                if self.shared_requests.get(key) is shared:
+                    del self.shared_requests[key]
+
+        shared.done(forget, forget)
+
+        promise = self.command_promise(command, args, block=block, timeout=timeout, priority=priority)
+        self.forward(self.transformed(promise, transform), shared)
+
+        return shared
+
+    @staticmethod
+    def forward(source, target):
+        # Settles target like source, along with the round trip time
+        def fulfilled(value):
+            target.rtt = getattr(source, "rtt", None)
+            target.fulfill(value)
+
+        source.done(fulfilled, target.reject)
+
+    @staticmethod
+    def transformed(promise, transform):
+        # promise.then(transform), keeping the round trip time
+        result = Promise()
+
+        def fulfilled(value):
+            try:
+                value = transform(value) if transform else value
+            except Exception as e:
+                result.reject(e)
+                return
+
+            result.rtt = getattr(promise, "rtt", None)
+            result.fulfill(value)
+
+        promise.done(fulfilled, result.reject)
+
+        return result
+
+    def retrying_promise(self, command, args, transform=None, retries=3, timeout=10, priority=NORMAL):
+        # Retries are scheduled on the deadline thread, nobody blocks
+        self.retry_policy.request_started()
+        result = Promise()
+
+        def attempt(n):
+            promise = self.request_promise(command, args, transform, timeout, priority=priority)
+            promise.done(lambda value: succeeded(promise, value), lambda error: failed(n, error))
+
+        def succeeded(promise, value):
+            # The round trip time of the attempt that got through
+            result.rtt = getattr(promise, "rtt", None)
+            result.fulfill(value)
+
+        def failed(n, error):
+            if self.retry_policy.should_retry(error, n, retries):
+                self.deadlines.schedule(self.retry_policy.delay(error, n), attempt, n + 1)
+            else:
+                result.reject(error)
+
+        attempt(0)
+
+        return result
+
+    def settle(self, promise, callback=None):
+        # Hands a request promise to the caller the way wrap_request would
+        if callback:
+            promise.done(callback)
+            return promise
+        else:
+            return promise.get()
+
+    def wrap_request(self, command, args, callback=None, transform=None, retries=3, timeout=10, priority=NORMAL):
         assert retries >= 1
         assert not callback or hasattr(callback, '__call__')
         assert not transform or hasattr(transform, '__call__')
 
         if callback:
-            promise = self.send_command(command, args).then(transform)
-            promise.done(callback)
-            return promise
+            result = self.retrying_promise(command, args, transform, retries, timeout, priority)
+            result.done(callback)
+            return result
         else:
-            last_exception = None
+            self.retry_policy.request_started()
 
             for attempt in range(0, retries):
-                promise = self.send_command(command, args).then(transform)
+                promise = self.request_promise(command, args, transform, timeout, block=True, priority=priority)
+                promise.wait(timeout)
 
-                try:
-                    return promise.get(timeout)
-                except SpotifyDisconnectedError as e:
-                    raise e
-                except SpotifyCommandError as e:
-                    raise e
-                except Exception as e:
-                    last_exception = e
+                if promise.isFulfilled:
+                    return promise.value
+
+                error = promise.reason if promise.isRejected else SpotifyTimeoutError()
+
+                if not self.retry_policy.should_retry(error, attempt, retries):
+                    raise error
 
-            raise last_exception or SpotifyTimeoutError()
+                time.sleep(self.retry_policy.delay(error, attempt))
 
-    def recv_packet(self, msg):
+    def recv_packet(self, msg, ws=None):
+        ws = ws or self.ws
         logger.debug("recv " + str(msg))
         packet = json.loads(str(msg))
         if "error" in packet:
-            self.handle_error(packet)
+            self.handle_error(packet, ws)
         elif "message" in packet:
-            self.handle_message(packet["message"])
+            self.handle_message(packet["message"], ws)
         elif "id" in packet:
             pid = packet["id"]
 
-            if pid in self.cmd_promises:
-                promise = self.cmd_promises.pop(pid)
-                promise.fulfill(packet["result"])
+            promise = self.pop_promise(ws, pid)
+
+            if promise is not None:
+                # Keep callbacks and transforms off the websocket thread
+                self.callback_executor.submit(promise.fulfill, packet["result"])
+            elif self.is_late_response(ws, pid):
+                logger.debug("Late response with id " + str(pid))
             else:
                 logger.warning("Unhandled command response with id " + str(pid))
 
+    def is_late_response(self, ws, pid):
+        # Ids are handed out in increasing order, a known id that is not
+        # pending anymore belongs to a command that already expired.
+        if isinstance(pid, int) and pid < ws.seq:
+            self.late_responses += 1
+            return True
+        else:
+            return False
+
     def work_callback(self, resp):
         logger.debug("Got ack for message reply")
 
-    def handle_message(self, msg):
+    def handle_message(self, msg, ws=None):
+        # Replies go out on the socket the message arrived on
+        ws = ws or self.ws
         cmd = msg[0]
 
         if len(msg) > 1:
@@ -1066,7 +1938,7 @@ class SpotifyAPI():
 
         if cmd == "do_work":
             logger.debug("Got do_work message, payload: " + payload)
-            self.wrap_request("sp/work_done", ["v1"], self.work_callback)
+            self.send_command("sp/work_done", ["v1"], self.work_callback, ws=ws)
         elif cmd == "ping_flash2":
             if len(msg[1]) >= 20:
                 key = [
@@ -1144,12 +2016,14 @@ class SpotifyAPI():
                         output.append(arr[val])
                 pong = u' '.join(map(unicode, output))
                 logger.debug("Sending pong %s" % pong)
-                self.send_command("sp/pong_flash2", [pong, ])
+                self.send_command("sp/pong_flash2", [pong, ], ws=ws, bypass_window=True)
         elif cmd == "login_complete":
             pass
             # self.login_callback(None)
 
-    def handle_error(self, err):
+    def handle_error(self, err, ws=None):
+        ws = ws or self.ws
+
         if len(err) < 2:
             logger.error("Unknown error " + str(err))
 
@@ -1185,12 +2059,19 @@ class SpotifyAPI():
         else:
             error_str = major_str + " - " + minor_str
 
+        # Back off the in-flight window instead of hammering a rate limited backend
+        rate_limited = major == 8 or minor in (8, 429)
+
         if 'id' in err:
             pid = err["id"]
+            promise = self.pop_promise(ws, pid, rate_limited)
 
-            if pid in self.cmd_promises:
-                promise = self.cmd_promises.pop(pid)
-                promise.reject(SpotifyCommandError(major, minor, error_str))
+            if promise is not None:
+                self.callback_executor.submit(promise.reject, SpotifyCommandError(major, minor, error_str))
+            else:
+                self.is_late_response(ws, pid)
+        elif rate_limited and self.window:
+            self.window.decrease()
 
         logger.error(error_str)
 
@@ -1199,4 +2080,4 @@ class SpotifyAPI():
 
         while not stop:
             self.heartbeat()
-            stop = self.heartbeat_marker.wait(timeout=18)
+            stop = self.heartbeat_marker.wait(timeout=self.HEARTBEAT_INTERVAL)
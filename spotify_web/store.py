@@ -0,0 +1,68 @@
+import time
+import sqlite3
+from threading import RLock
+
+
+class SQLiteMetadataStore(object):
+    """Keeps raw metadata protobufs in an SQLite database across restarts."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = RLock()
+
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS metadata ("
+                            "kind INTEGER NOT NULL, gid BLOB NOT NULL, body BLOB NOT NULL, "
+                            "fetched REAL NOT NULL, expires REAL NOT NULL, etag BLOB, "
+                            "PRIMARY KEY (kind, gid))")
+            self.db.execute("CREATE TEMP TABLE wanted (kind INTEGER NOT NULL, gid BLOB NOT NULL, "
+                            "PRIMARY KEY (kind, gid))")
+            self.db.commit()
+
+    def get_many(self, ids):
+        # Returns {id: (body, expires, etag)} for the ids that are stored
+        keys = dict(((id.kind, id.gid), id) for id in ids)
+        if not keys:
+            return {}
+
+        with self.lock:
+            try:
+                self.db.executemany("INSERT OR IGNORE INTO wanted VALUES (?, ?)",
+                                    [(kind, buffer(gid)) for kind, gid in keys])
+                rows = self.db.execute("SELECT m.kind, m.gid, m.body, m.expires, m.etag FROM wanted w "
+                                       "JOIN metadata m ON m.kind = w.kind AND m.gid = w.gid").fetchall()
+            finally:
+                self.db.execute("DELETE FROM wanted")
+                self.db.commit()
+
+        return dict((keys[(kind, str(gid))], (str(body), expires, str(etag) if etag is not None else None))
+                    for kind, gid, body, expires, etag in rows)
+
+    def put_many(self, entries):
+        # entries are (id, body, expires, etag)
+        now = time.time()
+
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+                                [(id.kind, buffer(id.gid), buffer(body), now, expires,
+                                  buffer(etag) if etag is not None else None)
+                                 for id, body, expires, etag in entries])
+            self.db.commit()
+
+    def touch_many(self, entries):
+        # entries are (id, expires, etag) of revalidated objects
+        with self.lock:
+            self.db.executemany("UPDATE metadata SET expires = ?, etag = ? WHERE kind = ? AND gid = ?",
+                                [(expires, buffer(etag) if etag is not None else None, id.kind, buffer(id.gid))
+                                 for id, expires, etag in entries])
+            self.db.commit()
+
+    def delete_many(self, ids):
+        with self.lock:
+            self.db.executemany("DELETE FROM metadata WHERE kind = ? AND gid = ?",
+                                [(id.kind, buffer(id.gid)) for id in ids])
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
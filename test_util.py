@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# Offline tests, they need no account and no network.
+
+import os
+import time
+import random
+import base64
+import binascii
+import unittest
+
+from aplus import Promise
+
+from spotify_web.cache import NegativeCache, MetadataCache, CACHE_NO
+from spotify_web.codec import encode_b64, decode_b64, encode_message, decode_message
+from spotify_web.lazy import LazyMessage
+from spotify_web.proto import mercury_pb2, metadata_pb2
+from spotify_web.restrictions import RestrictionIndex
+from spotify_web.spotify import SpotifyAPI, SpotifyUtil, SpotifyId, MissingMetadata, base62
+from spotify_web.store import SQLiteMetadataStore
+
+
+# The digit by digit versions SpotifyUtil used to have
+def old_id2uri(uritype, v):
+    res = []
+    v = int(v, 16)
+    while v > 0:
+        res = [v % 62] + res
+        v /= 62
+    id = ''.join([base62[i] for i in res])
+    return "spotify:" + uritype + ":" + id.rjust(22, "0")
+
+
+def old_uri2id(uri):
+    parts = uri.split(":")
+    if len(parts) > 3 and parts[3] == "playlist":
+        s = parts[4]
+    else:
+        s = parts[2]
+
+    v = 0
+    for c in s:
+        v = v * 62 + base62.index(c)
+    return hex(v)[2:-1].rjust(32, "0")
+
+
+def old_gid2uri(uritype, gid):
+    return old_id2uri(uritype, SpotifyUtil.gid2id(gid))
+
+
+# SpotifyAPI.is_track_available before restrictions were compiled, with
+# the forbidden check using the country asked about
+def old_is_track_available(track, country, account_type):
+    allowed_countries = []
+    forbidden_countries = []
+    available = False
+
+    for restriction in track.restriction:
+        allowed_str = restriction.countries_allowed
+        allowed_countries += [allowed_str[i:i + 2] for i in range(0, len(allowed_str), 2)]
+
+        forbidden_str = restriction.countries_forbidden
+        forbidden_countries += [forbidden_str[i:i + 2] for i in range(0, len(forbidden_str), 2)]
+
+        allowed = not restriction.HasField("countries_allowed") or country in allowed_countries
+        forbidden = country in forbidden_countries and len(forbidden_countries) > 0
+
+        if country in allowed_countries and country in forbidden_countries:
+            allowed = True
+            forbidden = False
+
+        account_type_map = {
+            "premium": 1,
+            "unlimited": 1,
+            "free": 0
+        }
+
+        applicable = account_type_map[account_type] in restriction.catalogue
+
+        available = True == allowed and False == forbidden and True == applicable
+        if available:
+            break
+
+    return available
+
+
+def make_track(*restrictions):
+    # restrictions are (catalogues, allowed, forbidden), None leaves a
+    # country list unset
+    track = metadata_pb2.Track()
+    track.gid = os.urandom(16)
+
+    for catalogues, allowed, forbidden in restrictions:
+        restriction = track.restriction.add()
+        restriction.catalogue.extend(catalogues)
+
+        if allowed is not None:
+            restriction.countries_allowed = allowed
+        if forbidden is not None:
+            restriction.countries_forbidden = forbidden
+
+    return track
+
+
+def make_reply(obj=None, status_code=200, ttl=None, etag=None, cache_policy=None):
+    reply = mercury_pb2.MercuryReply()
+    reply.status_code = status_code
+
+    if obj is not None:
+        reply.body = obj.SerializeToString()
+    if ttl is not None:
+        reply.ttl = ttl
+    if etag is not None:
+        reply.etag = etag
+    if cache_policy is not None:
+        reply.cache_policy = cache_policy
+
+    return reply
+
+
+class ReplayAPI(SpotifyAPI):
+    # Answers metadata batches from a dict of tracks instead of a socket,
+    # ids requested with an etag get a 304
+
+    def __init__(self, tracks, **kwargs):
+        SpotifyAPI.__init__(self, **kwargs)
+        self.tracks = tracks
+        self.requests = []
+
+    def metadata_batch(self, ids, priority=None, etags=None):
+        etags = etags or [None] * len(ids)
+        self.requests.append((ids, etags))
+        replies = []
+
+        for id, etag in zip(ids, etags):
+            if etag is not None:
+                replies.append((make_reply(status_code=304, ttl=60, etag=etag), MissingMetadata(304)))
+            elif id in self.tracks:
+                track = self.tracks[id]
+                replies.append((make_reply(track, ttl=60, etag="etag"), track))
+            else:
+                replies.append((make_reply(status_code=404), MissingMetadata(404)))
+
+        promise = Promise()
+        promise.fulfill(replies)
+        return promise
+
+
+class Base62Test(unittest.TestCase):
+    gids = [os.urandom(16) for i in range(1000)] + [
+        "\x00" * 16,
+        "\x00" * 15 + "\x01",
+        "\x00" * 8 + "\xff" * 8,
+        "\x00\x00" + os.urandom(14),
+        "\x00" * 7 + "\x80" + os.urandom(8),
+        "\xff" * 16,
+    ]
+
+    # Shorter than 16 bytes, gid2id pads them
+    short_gids = ["", "\x01", "\x00\x01", os.urandom(4), os.urandom(8), "\x00" + os.urandom(11)]
+
+    def test_gid2uri(self):
+        for gid in self.gids + self.short_gids:
+            self.assertEqual(old_gid2uri("track", gid), SpotifyUtil.gid2uri("track", gid))
+
+    def test_id2uri(self):
+        for gid in self.gids:
+            id = binascii.hexlify(gid)
+            self.assertEqual(old_id2uri("album", id), SpotifyUtil.id2uri("album", id))
+
+    def test_gids2uris(self):
+        gids = self.gids + self.short_gids
+        self.assertEqual([old_gid2uri("artist", gid) for gid in gids], SpotifyUtil.gids2uris("artist", gids))
+
+    def test_uri2id(self):
+        for gid in self.gids:
+            uri = old_gid2uri("track", gid)
+            id = SpotifyUtil.uri2id(uri)
+
+            self.assertEqual(binascii.hexlify(gid), id)
+
+            if int(id, 16) >= 2 ** 63:
+                self.assertEqual(old_uri2id(uri), id)
+
+    def test_uri2id_small_ids(self):
+        # hex() only adds the "L" the old code cut off for longs, smaller
+        # ids lost their last digit
+        uri = "spotify:track:" + "0" * 21 + "1"
+        self.assertEqual("0" * 31 + "1", SpotifyUtil.uri2id(uri))
+        self.assertEqual("0" * 32, old_uri2id(uri))
+
+    def test_uri2gid(self):
+        for gid in self.gids:
+            self.assertEqual(gid, SpotifyUtil.uri2gid(SpotifyUtil.gid2uri("track", gid)))
+
+        self.assertEqual(self.gids, SpotifyUtil.uris2gids(SpotifyUtil.gids2uris("track", self.gids)))
+
+    def test_playlist_uri(self):
+        gid = os.urandom(16)
+        uri = "spotify:user:someone:playlist:" + SpotifyUtil.gid2uri("track", gid).split(":")[2]
+        self.assertEqual(binascii.hexlify(gid), SpotifyUtil.uri2id(uri))
+
+    def test_short_base62(self):
+        self.assertEqual(SpotifyUtil.base622int("0" * 20 + "1z"), SpotifyUtil.base622int("1z"))
+        self.assertEqual(62 + base62.index("z"), SpotifyUtil.base622int("1z"))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, SpotifyUtil.base622int, "0" * 21 + "-")
+        self.assertRaises(ValueError, SpotifyUtil.base622int, "0" * 23)
+        self.assertRaises(ValueError, SpotifyUtil.int2base62, 62 ** 22)
+
+    def test_spotify_id(self):
+        gid = "\x00" + os.urandom(15)
+        id = SpotifyId.from_uri(SpotifyUtil.gid2uri("track", gid))
+
+        self.assertEqual(gid, id.gid)
+        self.assertEqual(old_gid2uri("track", gid), id.uri)
+        self.assertIs(id, SpotifyId("track", gid))
+
+
+class RestrictionTest(unittest.TestCase):
+    countries = ["SE", "DE", "FR", "GB", "US", "NO", "FI", "DK"]
+    account_types = [("premium", 1), ("unlimited", 1), ("free", 0)]
+
+    def assertSameAsOld(self, tracks, index=None):
+        if index is None:
+            index = RestrictionIndex()
+
+        # XX is in no restriction at all
+        for country in self.countries + ["XX"]:
+            for account_type, catalogue in self.account_types:
+                expected = [old_is_track_available(track, country, account_type) for track in tracks]
+
+                self.assertEqual(expected, index.available_in(tracks, country, catalogue))
+                self.assertEqual(expected, [index.available(track, country, catalogue) for track in tracks])
+
+    def test_cases(self):
+        self.assertSameAsOld([
+            make_track(),
+            make_track(([1], None, None)),
+            make_track(([], None, None)),
+            make_track(([0, 1], "SEDE", None)),
+            make_track(([1], "", None)),
+            make_track(([1], None, "SEDE")),
+            make_track(([1], None, "")),
+            make_track(([1], "SEDE", "DEFR")),
+            make_track(([0], "SE", None), ([1], "DE", None)),
+            make_track(([1], None, "SE"), ([1], "SE", None)),
+            make_track(([1], "SE", None), ([1], None, "SE")),
+            make_track(([1], "SE", None), ([1], None, "DE")),
+            make_track(([1], None, "SE"), ([0], None, "DE")),
+        ])
+
+    def test_random(self):
+        rng = random.Random(4)
+        tracks = []
+
+        for i in range(2000):
+            restrictions = []
+
+            for j in range(rng.randint(0, 3)):
+                catalogues = rng.sample([0, 1], rng.randint(0, 2))
+                allowed = "".join(rng.sample(self.countries, rng.randint(0, 4))) if rng.random() < 0.6 else None
+                forbidden = "".join(rng.sample(self.countries, rng.randint(0, 4))) if rng.random() < 0.5 else None
+                restrictions.append((catalogues, allowed, forbidden))
+
+            tracks.append(make_track(*restrictions))
+
+        index = RestrictionIndex()
+        self.assertSameAsOld(tracks, index)
+        # Compiled once per track
+        self.assertEqual(len(tracks), index.compilations)
+
+    def test_lazy(self):
+        track = make_track(([1], "SE", "DE"))
+        lazy = LazyMessage(metadata_pb2.Track, track.SerializeToString())
+
+        index = RestrictionIndex()
+        self.assertEqual([True, False], [index.available(lazy, "SE", 1), index.available(lazy, "DE", 1)])
+        self.assertEqual([False], index.available_in([lazy], "SE", 0))
+
+    def test_api(self):
+        api = SpotifyAPI()
+        api.account_type = "premium"
+        api.country = "SE"
+
+        track = make_track(([1], None, "DE"))
+        alternative = track.alternative.add()
+        alternative.CopyFrom(make_track(([1], "DE", None)))
+
+        self.assertEqual([True, False], [api.is_track_available(track, "SE"), api.is_track_available(track, "DE")])
+        self.assertEqual([False], api.available_in([track], "DE"))
+        self.assertEqual(alternative.gid, api.recurse_alternatives(track, "DE").gid)
+        self.assertIs(track, api.recurse_alternatives(track))
+
+        api.shutdown()
+
+
+class NegativeCacheTest(unittest.TestCase):
+    def test_expiry(self):
+        cache = NegativeCache(ttl=0.05)
+        cache.add("a", 404)
+
+        self.assertEqual(404, cache.get("a"))
+        self.assertEqual(None, cache.get("b"))
+
+        time.sleep(0.1)
+        self.assertEqual(None, cache.get("a"))
+        self.assertEqual(0, len(cache))
+
+    def test_max_size(self):
+        cache = NegativeCache(max_size=10)
+        for i in range(25):
+            cache.add(i, 410)
+
+        self.assertEqual(10, len(cache))
+        self.assertEqual(410, cache.get(24))
+
+
+class MetadataCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.ids = [SpotifyId("track", os.urandom(16)) for i in range(5)]
+        self.tracks = [make_track() for id in self.ids]
+
+    def test_lookup(self):
+        cache = MetadataCache()
+        cache.store(self.ids[0], self.tracks[0], make_reply(self.tracks[0], ttl=60, etag="a"))
+        cache.store(self.ids[1], self.tracks[1], make_reply(self.tracks[1], ttl=-1, etag="b"))
+        cache.store(self.ids[2], self.tracks[2], make_reply(self.tracks[2], cache_policy=CACHE_NO))
+
+        found = cache.lookup_many(self.ids)
+        self.assertEqual((self.tracks[0], "a", True), found[self.ids[0]])
+        self.assertEqual((self.tracks[1], "b", False), found[self.ids[1]])
+        self.assertEqual(2, len(found))
+        self.assertEqual({"size": 2, "hits": 1, "misses": 4, "loaded": 0, "revalidated": 0}, cache.stats())
+
+    def test_eviction(self):
+        cache = MetadataCache(max_size=3)
+        cache.store_many([(id, track, None) for id, track in zip(self.ids[:3], self.tracks)])
+        cache.lookup(self.ids[0])
+        cache.store(self.ids[3], self.tracks[3])
+
+        # The least recently used one goes
+        self.assertEqual([self.ids[2], self.ids[0], self.ids[3]], list(cache.entries))
+
+    def test_refresh(self):
+        cache = MetadataCache(max_size=1)
+        cache.store(self.ids[0], self.tracks[0], make_reply(self.tracks[0], ttl=-1, etag="a"))
+        obj, etag, fresh = cache.lookup(self.ids[0])
+        cache.store(self.ids[1], self.tracks[1])
+
+        # Evicted in the meantime, the object found by the lookup is kept
+        cache.refresh(self.ids[0], obj, etag, make_reply(status_code=304, ttl=60))
+        self.assertEqual((self.tracks[0], "a", True), cache.lookup(self.ids[0]))
+
+    def test_backing_store(self):
+        store = SQLiteMetadataStore(":memory:")
+        cache = MetadataCache(max_size=0, backing_store=store)
+        cache.store(self.ids[0], self.tracks[0], make_reply(self.tracks[0], ttl=-1, etag="a"))
+        self.assertEqual(0, len(cache))
+
+        obj, etag, fresh = cache.lookup(self.ids[0])
+        self.assertEqual((obj, etag, fresh), (self.tracks[0], "a", False))
+
+        cache.refresh(self.ids[0], obj, etag, make_reply(status_code=304, ttl=60, etag="b"))
+        body, expires, etag = store.get_many([self.ids[0]])[self.ids[0]]
+        self.assertEqual((self.tracks[0].SerializeToString(), "b"), (body, etag))
+        self.assertTrue(expires > time.time())
+
+        cache.store(self.ids[0], self.tracks[0], make_reply(self.tracks[0], cache_policy=CACHE_NO))
+        self.assertEqual({}, store.get_many(self.ids))
+
+
+class SQLiteMetadataStoreTest(unittest.TestCase):
+    def test_round_trip(self):
+        store = SQLiteMetadataStore(":memory:")
+        ids = [SpotifyId("track", os.urandom(16)), SpotifyId("album", os.urandom(16))]
+        # Same gid as a track, another kind
+        other = SpotifyId("artist", ids[0].gid)
+
+        store.put_many([(ids[0], "\x00body", 10.0, None), (ids[1], "album", 20.0, "\xffetag")])
+        self.assertEqual({ids[0]: ("\x00body", 10.0, None), ids[1]: ("album", 20.0, "\xffetag")},
+                         store.get_many(ids + [other]))
+
+        store.touch_many([(ids[0], 30.0, "etag")])
+        store.delete_many([ids[1]])
+        self.assertEqual({ids[0]: ("\x00body", 30.0, "etag")}, store.get_many(ids))
+
+        store.close()
+
+
+class RevalidationTest(unittest.TestCase):
+    def make_api(self, metadata_cache):
+        self.ids = [SpotifyId("track", os.urandom(16)) for i in range(4)]
+        tracks = dict((id, make_track()) for id in self.ids[:3])
+        api = ReplayAPI(tracks, metadata_cache=metadata_cache)
+        self.addCleanup(api.shutdown)
+
+        for id, track in tracks.items():
+            api.metadata_cache.store(id, track, make_reply(track, ttl=-1, etag="e" + id.gid))
+
+        return api, [tracks.get(id) for id in self.ids]
+
+    def check(self, metadata_cache):
+        api, tracks = self.make_api(metadata_cache)
+        items = api.metadata_items(self.ids)[1].get()
+
+        # Stored objects come back lazily, they go on the left
+        self.assertEqual(items[:3], tracks[:3])
+        self.assertEqual(404, items[3].status_code)
+        # One request, expired objects with their etag
+        etags = dict([(id, "e" + id.gid) for id in self.ids[:3]] + [(self.ids[3], None)])
+        self.assertEqual([etags], [dict(zip(ids, etags)) for ids, etags in api.requests])
+
+        # Fresh again, nothing is requested
+        self.assertEqual(api.metadata_items(self.ids[:3])[1].get(), tracks[:3])
+        self.assertEqual(1, len(api.requests))
+        self.assertEqual(3, api.metadata_cache.revalidated)
+
+    def test_memory(self):
+        self.check(MetadataCache())
+
+    def test_evicted(self):
+        # Only the backing store keeps the objects
+        self.check(MetadataCache(max_size=0, backing_store=SQLiteMetadataStore(":memory:")))
+
+
+class CodecTest(unittest.TestCase):
+    def test_encode(self):
+        for size in range(0, 300):
+            data = os.urandom(size)
+            self.assertEqual(base64.encodestring(data).replace("\n", ""), encode_b64(data))
+
+    def test_decode(self):
+        for size in range(0, 300):
+            data = os.urandom(size)
+            self.assertEqual(data, decode_b64(base64.encodestring(data)))
+            self.assertEqual(data, decode_b64(unicode(encode_b64(data))))
+
+    def test_message(self):
+        request = mercury_pb2.MercuryRequest()
+        request.uri = "hm://metadata/track/" + binascii.hexlify(os.urandom(16))
+        request.body = "GET"
+
+        self.assertEqual(request, decode_message(mercury_pb2.MercuryRequest, encode_message(request)))
+
+
+if __name__ == '__main__':
+    unittest.main()